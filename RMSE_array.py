@@ -6,7 +6,7 @@ Created on Mon Jul 15 12:00:54 2019
 """
 
 import numpy as np
-from osgeo import ogr, gdal, osr
+from osgeo import ogr, osr
 import rasterio
 from rasterio.features import shapes
 from shapely.geometry import shape, Point
@@ -14,7 +14,16 @@ import geopandas as gpd
 import pandas as pd
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-import random, argparse, os, logging
+import argparse, os, logging
+
+from dataset_pool import open_dataset
+from spatial_sampling import MODES, sample_region
+
+try:
+    from shapely import contains_xy
+except ImportError:
+    ## Shapely < 2.0
+    from shapely.vectorized import contains as contains_xy
 
 
 def calc_rmse(l1, l2):
@@ -34,7 +43,7 @@ def raster_bounds(path):
     '''
     GDAL only version of getting bounds
     '''
-    src = gdal.Open(path)
+    src = open_dataset(path)
     gt = src.GetGeoTransform()
     minx = gt[0]
     maxy = gt[3]
@@ -67,42 +76,35 @@ def raster_bounds(path):
     return bb
 
 
-def random_points_within(num_points, poly1, poly2):
+def random_points_within(num_points, poly1, poly2, mode='uniform', seed=None):
     '''
     Creates num_points with the boundaries of poly1 and poly2,
     returns a list of shapely Points
+    mode: 'uniform', 'stratified' or 'poisson' (see spatial_sampling)
+    seed: seed or numpy Generator for reproducible points
     '''
     print('Creating random points...')
-    min_x1, min_y1, max_x1, max_y1 = poly1.bounds
-    min_x2, min_y2, max_x2, max_y2 = poly2.bounds
-    
-    min_x = max(min_x1, min_x2)
-    min_y = max(min_y1, min_y2)
-    max_x = min(max_x1, max_x2)
-    max_y = min(max_y1, max_y2)
-    
-    points = []
+    overlap = poly1.intersection(poly2)
+    xs, ys = sample_region(num_points, overlap.bounds, within=lambda x, y: contains_xy(overlap, x, y),
+                           mode=mode, seed=seed, area=overlap.area)
 
-    while len(points) < num_points:
-        random_point = Point([random.uniform(min_x, max_x), random.uniform(min_y, max_y)])
-        if (random_point.within(poly1) and random_point.within(poly2)):
-            points.append(random_point)
+    return [Point(x, y) for x, y in zip(xs, ys)]
 
-    return points
 
-
-def sample_points(dem1_path, dem2_path, num_pts=1000):
+def sample_points(dem1_path, dem2_path, num_pts=1000, mode='uniform', seed=None):
     '''
     Samples num_pts from dem1 and dem2 and returns a dataframe of values, as well as 
     difference of dem1 - dem2
+    mode: how points are spread, 'uniform', 'stratified' or 'poisson'
+    seed: seed for reproducible points
     '''
     # Read as array
-    dem1_src = gdal.Open(dem1_path)
+    dem1_src = open_dataset(dem1_path)
 #    dem1_nodata = dem1_src.GetRasterBand(1).GetNoDataValue()
     dem1 = dem1_src.ReadAsArray()
     dem1_gt = dem1_src.GetGeoTransform()
             
-    dem2_src = gdal.Open(dem2_path)
+    dem2_src = open_dataset(dem2_path)
 #    dem2_nodata = dem2_src.GetRasterBand(1).GetNoDataValue()
     dem2 = dem2_src.ReadAsArray()
     dem2_gt = dem2_src.GetGeoTransform()
@@ -115,7 +117,7 @@ def sample_points(dem1_path, dem2_path, num_pts=1000):
             
     
     ## Generate random points within data extents of DEMs
-    random_pts = random_points_within(num_pts, dem1_bb, dem2_bb)
+    random_pts = random_points_within(num_pts, dem1_bb, dem2_bb, mode=mode, seed=seed)
     
     geoms = []
     dem1_vals = []
@@ -180,7 +182,11 @@ if __name__ == '__main__':
                         help='Option path to save plots: histogram of differences, scatter of values, map of sample points')
     parser.add_argument('-w', '--write_shp', type=str,
                         help='Optional path to write shapefile of sample points')
-    
+    parser.add_argument('--mode', type=str, default='uniform', choices=MODES,
+                        help='How sample points are spread: uniform, stratified or poisson. Default uniform')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for the random sample points, for reproducible results.')
+
     args = parser.parse_args()
     
     
@@ -188,7 +194,8 @@ if __name__ == '__main__':
     num_pts = args.num_pts if args.num_pts else 1000
 
     # Sample DEMs at random points
-    gdf = sample_points(args.dem1_path, args.dem2_path, num_pts=num_pts)
+    gdf = sample_points(args.dem1_path, args.dem2_path, num_pts=num_pts, mode=args.mode,
+                        seed=args.seed)
 
     ## Calculate RMSE
     rmse_val = calc_rmse(list(gdf['DEM1_value']), list(gdf['DEM2_value']))    
@@ -2,9 +2,11 @@ import logging
 import numpy as np
 import os
 from osgeo import gdal, osr
-import random
 
-from RasterWrapper import Raster
+from RasterWrapper import Raster, Window, overview_factors
+from RasterStack import RasterStack
+from tile_cache import get_tile_cache
+from spatial_sampling import get_rng, sample_region
 
 
 def raster_bounds(raster_obj):
@@ -48,6 +50,89 @@ def minimum_bounding_box(raster_objs):
     return projWin
 
 
+def iter_diff_blocks(dem1, dem2, method='bilinear'):
+    '''
+    Yields the differences dem1 - dem2 where both are valid, as 1-D float64
+    arrays, block by block over the overlap on the grid of dem1. dem2 is
+    read from its matching window if the grids line up, otherwise it is
+    sampled at each dem1 pixel center, e.g. for overviews of DEMs whose
+    origins are not a multiple of the overview factor apart.
+    method: resampling of dem2 when the grids do not line up (see RasterStack)
+    '''
+    stack = RasterStack([dem1, dem2], method=method)
+    for window, arrs in stack.iter_blocks():
+        valid = ~np.ma.getmaskarray(arrs).any(axis=0)
+        yield arrs[0].data[valid].astype(np.float64) - arrs[1].data[valid]
+
+
+class DiffStats():
+    '''
+    Streaming statistics of differences: count, sum, sum of squares, min, max
+    and the mean and variance by Welford's method, updated a block at a time
+    (merging block statistics with Chan et al.'s formula).
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+
+    def update(self, diffs):
+        '''
+        Adds an array of differences.
+        '''
+        diffs = np.asarray(diffs, dtype=np.float64)
+        if diffs.size == 0:
+            return
+        block = DiffStats()
+        block.count = diffs.size
+        block.total = diffs.sum()
+        block.total_sq = np.dot(diffs, diffs)
+        block.mean = block.total / block.count
+        block.m2 = ((diffs - block.mean)**2).sum()
+        block.min = diffs.min()
+        block.max = diffs.max()
+        self.merge(block)
+
+
+    def merge(self, other):
+        '''
+        Combines the statistics of other into these, e.g. from another block
+        or worker.
+        '''
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+
+    @property
+    def rmse(self):
+        return np.sqrt(self.total_sq / self.count) if self.count else np.nan
+
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+
+    def summary(self):
+        return {'count': int(self.count), 'rmse': float(self.rmse), 'mean': float(self.mean),
+                'std': float(self.std), 'min': float(self.min), 'max': float(self.max)}
+
+
 def calc_rmse(l1, l2):
     '''
     Calculates RMSE of two lists of numbers.
@@ -61,40 +146,182 @@ def calc_rmse(l1, l2):
     return rmse_val
 
 
-def sample_random_points(dem1, dem2, n):
+def sample_random_points(dem1, dem2, n, batch_size=10000, mode='uniform', seed=None):
     """
     Generates n random points within projWin [ulx, uly, lrx, lry]
+    and samples both DEMs at them, returning a list of (val1, val2) where
+    neither value is nodata. Points are generated and sampled in batches.
+    mode: 'uniform', 'stratified' or 'poisson' (see spatial_sampling)
+    seed: seed or numpy Generator for reproducible points
     """
-    dem1_nodata = dem1.nodata_val
-    dem2_nodata = dem2.nodata_val
-    
     projWin = minimum_bounding_box([dem1, dem2])
-    minx, miny, maxx, maxy = projWin
-    
-    sample_vals = []
-    while len(sample_vals) < n:
-        pt = (random.uniform(miny, maxy), random.uniform(minx, maxx))
-        val1 = dem1.SamplePoint(pt)
-        val2 = dem2.SamplePoint(pt)
-        if val1 != dem1_nodata and val2 != dem2_nodata and val1 is not None and val2 is not None:
-            sample_vals.append((val1, val2))
-        else:
-            pass
+    ulx, uly, lrx, lry = projWin
+
+    ## Values of the pixels containing the points, as RMSE_points.sample_points
+    stack = RasterStack([dem1, dem2])
+    def both_valid(xs, ys):
+        return ~np.ma.getmaskarray(stack.ReadPoints(ys, xs)).any(axis=0)
+
+    kwargs = {'batch_size': batch_size} if mode == 'uniform' else {}
+    xs, ys = sample_region(n, (ulx, lry, lrx, uly), within=both_valid, mode=mode, seed=seed,
+                           **kwargs)
+    ## Blocks read while testing validity are in the tile cache
+    vals1, vals2 = stack.ReadPoints(ys, xs).data
         
-    return sample_vals
+    return list(zip(vals1, vals2))
     
+def bootstrap_rmse(diffs, num_boot=1000, alpha=0.05, max_elements=10000000, seed=None):
+    """
+    Percentile bootstrap confidence interval of the RMSE of diffs.
+    Resamples are drawn as a single (num_boot, n) index array, split into
+    chunks of resamples only if it would be over max_elements.
+    seed: seed or numpy Generator for reproducible intervals
+    Returns (lower, upper) of the 1 - alpha interval, NaN if there are no diffs.
+    """
+    rng = get_rng(seed)
+    sq_diffs = np.asarray(diffs, dtype=np.float64)**2
+    n = sq_diffs.size
+    if n == 0:
+        logging.warning('No differences to bootstrap.')
+        return np.nan, np.nan
+    chunk = max(1, max_elements // n)
+    rmses = np.concatenate([np.sqrt(sq_diffs[rng.integers(0, n, size=(min(chunk, num_boot - i), n))]
+                                    .mean(axis=1))
+                            for i in range(0, num_boot, chunk)])
+    lower, upper = np.percentile(rmses, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+
+    return lower, upper
+
+
+def adaptive_rmse(draw_diffs, ci_width, n=1000, max_n=1000000, num_boot=1000, alpha=0.05,
+                  seed=None):
+    """
+    Samples differences until the bootstrap confidence interval of the RMSE is
+    narrower than ci_width, or max_n samples have been drawn, or a draw
+    returns no more samples (e.g. all new points were nodata).
+    draw_diffs: function taking a number of points and returning that many
+                sampled differences
+    n: number of samples to start with
+    seed: seed or numpy Generator for the bootstrap
+    Returns (diffs, rmse, (lower, upper)).
+    """
+    rng = get_rng(seed)
+    diffs = np.asarray(draw_diffs(n), dtype=np.float64)
+    while True:
+        lower, upper = bootstrap_rmse(diffs, num_boot=num_boot, alpha=alpha, seed=rng)
+        logging.info('{} samples: RMSE CI width {:.4f}'.format(len(diffs), upper - lower))
+        if len(diffs) == 0 or upper - lower <= ci_width or len(diffs) >= max_n:
+            break
+        ## Width shrinks with the square root of the sample size, draw about
+        ## enough more to reach the target
+        target = int(len(diffs) * 1.1 * ((upper - lower) / ci_width)**2)
+        target = min(max_n, max(target, 2 * len(diffs)))
+        new_diffs = np.asarray(draw_diffs(target - len(diffs)), dtype=np.float64)
+        if len(new_diffs) == 0:
+            logging.warning('No more samples could be drawn, stopping at {}.'.format(len(diffs)))
+            break
+        diffs = np.concatenate([diffs, new_diffs])
+    rmse = np.sqrt(np.mean(diffs**2)) if len(diffs) else np.nan
+
+    return diffs, rmse, (lower, upper)
+
+
 #dem1_p = r'V:\pgc\data\scratch\jeff\coreg\data\pc_align_reg\WV02_20150718-WV02_20150718\WV02_20150718_10300100464D6D00_1030010046298B00_seg4_2m_dem.tif'
 #dem2_p = r'V:\pgc\data\scratch\jeff\coreg\data\pc_align_reg\WV02_20150718-WV02_20150718\WV02_20150718-DEM.tif'
-def dem_RMSE(dem1_p, dem2_p, n):
+def dem_diff_stats(dem1, dem2):
+    """
+    Exact statistics of the differences dem1 - dem2 over every pixel where the
+    DEMs overlap and both are valid, streamed block by block so memory is
+    bounded by the block size. Returns DiffStats.
+    dem1, dem2: Raster objects, dem2 is resampled if it is not on the grid of dem1
+    """
+    stats = DiffStats()
+    for diffs in iter_diff_blocks(dem1, dem2):
+        stats.update(diffs)
+
+    return stats
+
+
+def dem_RMSE(dem1_p, dem2_p, n=1000, exact=False, ci_width=None, max_n=1000000, num_boot=1000,
+             mode='uniform', seed=None):
     """
     Calculate RMSE for two DEMs from
-    n sample points
+    n sample points, or from every overlapping pixel if exact.
+    The bootstrap confidence interval of sampled RMSEs is logged. If ci_width
+    is given, sampling continues until the interval is narrower than it (or
+    max_n points are sampled).
+    mode: how sample points are spread, 'uniform', 'stratified' or 'poisson'
+    seed: seed for the sample points and bootstrap
     """
+    if exact:
+        logging.info('Computing RMSE over full overlap...')
+        stats = dem_diff_stats(Raster(dem1_p, lazy=True), Raster(dem2_p, lazy=True))
+        logging.info('Valid overlapping pixels: {}'.format(stats.count))
+        print(stats.rmse)
+        return stats.rmse
+
     logging.info('Loading DEMs...')
-    dem1 = Raster(dem1_p)
-    dem2 = Raster(dem2_p)
+    ## Only read headers, sampling reads the blocks it needs through the tile cache
+    dem1 = Raster(dem1_p, lazy=True)
+    dem2 = Raster(dem2_p, lazy=True)
     logging.info('Sampling points...')
-    sample_values = sample_random_points(dem1, dem2, n=n)
-    x_vals, y_vals = zip(*sample_values)
-    rmse = calc_rmse(x_vals, y_vals)
+    ## One generator for all draws so adaptive sampling gets new points
+    rng = get_rng(seed)
+    def draw_diffs(k):
+        x_vals, y_vals = zip(*sample_random_points(dem1, dem2, n=k, mode=mode, seed=rng))
+        return np.array(x_vals, dtype=np.float64) - np.array(y_vals, dtype=np.float64)
+    if ci_width:
+        diffs, rmse, (lower, upper) = adaptive_rmse(draw_diffs, ci_width, n=n, max_n=max_n,
+                                                    num_boot=num_boot, seed=rng)
+    else:
+        diffs = draw_diffs(n)
+        rmse = np.sqrt(np.mean(diffs**2))
+        lower, upper = bootstrap_rmse(diffs, num_boot=num_boot, seed=rng)
+    get_tile_cache().log_stats(level=logging.DEBUG)
+    logging.info('RMSE 95% CI from {} samples: {:.4f} - {:.4f}'.format(len(diffs), lower, upper))
     print(rmse)
+    return rmse
+
+
+def progressive_RMSE(dem1_p, dem2_p, tolerance=0.05, max_rmse=None):
+    """
+    Estimates the RMSE of two DEMs coarse to fine: over every valid pixel of
+    the coarsest overview level both DEMs have (e.g. from batch_compute_stats),
+    then one level finer at a time down to full resolution, stopping once the
+    estimate changes by no more than tolerance (as a fraction of the estimate).
+    Overviews from batch_compute_stats are nearest neighbour, so each level is
+    a subsample of full resolution pixels. Where the overview grids of the
+    DEMs do not line up dem2 is sampled at the nearest pixel to each dem1
+    pixel center rather than interpolated, so differences are not smoothed
+    and every level can decide convergence.
+    max_rmse: reject the pair as soon as an estimate is over this, without
+              reading any finer levels
+    Returns (rmse, status, estimates) where status is 'converged', 'full'
+    (reached full resolution) or 'rejected', and estimates is a list of
+    (overview factor, rmse, count) for each level read.
+    """
+    factors1 = overview_factors(Raster(dem1_p, lazy=True).data_src)
+    factors2 = overview_factors(Raster(dem2_p, lazy=True).data_src)
+    factors = sorted(set(factors1) & set(factors2), reverse=True) + [1]
+
+    estimates = []
+    rmse = np.nan
+    for factor in factors:
+        overview = factor if factor > 1 else None
+        dem1 = Raster(dem1_p, lazy=True, overview=overview)
+        dem2 = Raster(dem2_p, lazy=True, overview=overview)
+        stats = DiffStats()
+        for diffs in iter_diff_blocks(dem1, dem2, method='nearest'):
+            stats.update(diffs)
+        logging.info('Overview {}: RMSE {:.4f} from {} pixels'.format(factor, stats.rmse, stats.count))
+        if stats.count == 0:
+            continue
+        previous = rmse
+        rmse = stats.rmse
+        estimates.append((factor, rmse, stats.count))
+        if max_rmse is not None and rmse > max_rmse:
+            return rmse, 'rejected', estimates
+        if factor > 1 and len(estimates) > 1 and abs(rmse - previous) <= tolerance * rmse:
+            return rmse, 'converged', estimates
+
+    return rmse, 'full', estimates
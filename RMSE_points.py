@@ -6,15 +6,27 @@ Created on Mon Jul 15 12:00:54 2019
 """
 
 import numpy as np
-from osgeo import ogr, gdal, osr
-import rasterio
-from rasterio.features import shapes
-from shapely.geometry import shape, Point
-import geopandas as gpd
+from osgeo import ogr, osr
+from shapely.geometry import Point
 import pandas as pd
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-import random, argparse, os, logging
+import argparse, os, logging
+
+from RasterWrapper import Raster
+from RasterStack import RasterStack
+from raster_footprint import valid_footprint
+from RMSE_array_2 import bootstrap_rmse, adaptive_rmse
+from robust_stats import robust_summary
+from spatial_sampling import MODES, get_rng, sample_region
+from point_samples import PointSamples
+
+try:
+    from shapely import contains_xy, prepare
+except ImportError:
+    ## Shapely < 2.0
+    from shapely.vectorized import contains as contains_xy
+    prepare = None
 
 
 def calc_rmse(l1, l2):
@@ -46,110 +58,122 @@ def calc_rmse(l1, l2):
 
 def raster_bounds(path):
     '''
-    Gets boundary of raster at path, ignoring no data values
+    Gets boundary of raster at path, ignoring no data values, as a
+    MultiPolygon of all the valid data (see raster_footprint).
+    The footprint is used to place sample points, so it is not simplified,
+    simplifying stretches it over jagged nodata edges.
     '''
     print('Getting raster bounds...')
-    with rasterio.drivers():
-        with rasterio.open(path) as src:
-            # Raster band
-            rb = src.read(1)
-            nodata = src.nodatavals[0]
-            # Array of 1's and 0's
-            binary = np.where(rb <= nodata, 0, 1)
-            # Array True, False
-            mask = np.where(binary == 1, True, False)
-            ## Create a dictionary of raster values and geometries, where 
-            ## the geometries are based on grouping the values in the binary array
-            ## and ignoring the False values in the mask
-            geoms = list(({'properties': {'raster_val': value}, 'geometry': shp} 
-            for i, (shp, value) in enumerate(shapes(binary, mask=mask, transform=src.affine))))
-            bb = shape(geoms[0]['geometry'])
-    return bb
-
-
-def random_points_within(num_points, poly1, poly2):
+    return valid_footprint(path, tolerance=0)
+
+
+def random_points_within(num_points, poly1, poly2, batch_size=10000, as_arrays=False,
+                         mode='uniform', seed=None):
     '''
     Creates num_points with the boundaries of poly1 and poly2,
-    returns a list of shapely Points
+    returns a list of shapely Points, or arrays of x and y if as_arrays.
+    Candidates are generated in batches over the bounds of the intersection of
+    the polygons and tested against it all at once.
+    mode: 'uniform', 'stratified' or 'poisson' (see spatial_sampling)
+    seed: seed or numpy Generator for reproducible points
     '''
     print('Creating random points...')
-    min_x1, min_y1, max_x1, max_y1 = poly1.bounds
-    min_x2, min_y2, max_x2, max_y2 = poly2.bounds
-    
-    min_x = max(min_x1, min_x2)
-    min_y = max(min_y1, min_y2)
-    max_x = min(max_x1, max_x2)
-    max_y = min(max_y1, max_y2)
-    
-    points = []
+    overlap = poly1.intersection(poly2)
+    if overlap.is_empty:
+        raise ValueError('Polygons do not overlap.')
+    if prepare is not None:
+        prepare(overlap)
 
-    while len(points) < num_points:
-        random_point = Point([random.uniform(min_x, max_x), random.uniform(min_y, max_y)])
-        if (random_point.within(poly1) and random_point.within(poly2)):
-            points.append(random_point)
+    kwargs = {'batch_size': batch_size} if mode == 'uniform' else {}
+    xs, ys = sample_region(num_points, overlap.bounds, within=lambda x, y: contains_xy(overlap, x, y),
+                           mode=mode, seed=seed, area=overlap.area, **kwargs)
+    if as_arrays:
+        return xs, ys
 
-    return points
+    return [Point(x, y) for x, y in zip(xs, ys)]
 
 
-def sample_points(dem1_path, dem2_path, num_pts=1000):
+def random_valid_points(num_points, dem1, dem2, mode='uniform', seed=None):
     '''
-    Samples num_pts from dem1 and dem2 and returns a dataframe of values, as well as 
-    difference of dem1 - dem2
+    Picks num_points pixel centers directly from the pixels where both DEMs
+    have valid data, so no candidates are rejected. Returns arrays of x and y.
+    dem1, dem2: Raster objects on the same grid
+    mode: 'uniform' picks pixels at random, 'stratified' or 'poisson' spread
+          points over the valid pixels (see spatial_sampling)
+    seed: seed or numpy Generator for reproducible points
     '''
-    # Read as array
-    dem1_src = gdal.Open(dem1_path)
-#    dem1_nodata = dem1_src.GetRasterBand(1).GetNoDataValue()
-    dem1 = dem1_src.ReadAsArray()
-    dem1_gt = dem1_src.GetGeoTransform()
-            
-    dem2_src = gdal.Open(dem2_path)
-#    dem2_nodata = dem2_src.GetRasterBand(1).GetNoDataValue()
-    dem2 = dem2_src.ReadAsArray()
-    dem2_gt = dem2_src.GetGeoTransform()
-    
-    
-    ## Get extents of DEMs exluding NoData
-    dem1_bb = raster_bounds(dem1_path)
-    dem2_bb = raster_bounds(dem2_path)
-#    bb_gdf = gpd.GeoDataFrame(geometry=[dem1_bb, dem2_bb])
-#    bb_gdf.to_file(r'V:\pgc\data\scratch\jeff\brash_island\dem\pc_align\dem_bb.shp', driver='ESRI Shapefile')
-            
+    print('Creating random points from valid pixels...')
+    rng = get_rng(seed)
+    win1, win2 = RasterStack([dem1, dem2]).windows
+    if win2 is None:
+        raise ValueError('DEMs must be on the same grid to sample from valid pixels.')
+    ## Build packed masks so only the overlap window is unpacked
+    dem1.ValidMask()
+    dem2.ValidMask()
+    valid_win = dem1.ValidWindow(*win1) & dem2.ValidWindow(*win2)
+    if mode == 'uniform':
+        valid = np.flatnonzero(valid_win)
+        if len(valid) == 0:
+            raise ValueError('DEMs have no overlapping valid pixels.')
+        picked = rng.choice(valid, size=num_points, replace=len(valid) < num_points)
+        rows, cols = np.divmod(picked, win1.xsize)
+    else:
+        if not valid_win.any():
+            raise ValueError('DEMs have no overlapping valid pixels.')
+        ## Sample in pixel coordinates of the window, snapped to pixel centers
+        def within(x, y):
+            return valid_win[np.minimum(y.astype(np.int64), win1.ysize - 1),
+                             np.minimum(x.astype(np.int64), win1.xsize - 1)]
+        xs, ys = sample_region(num_points, (0, 0, win1.xsize, win1.ysize), within=within,
+                               mode=mode, seed=rng)
+        rows = np.minimum(ys.astype(np.int64), win1.ysize - 1)
+        cols = np.minimum(xs.astype(np.int64), win1.xsize - 1)
+    xs = dem1.x_origin + (win1.xoff + cols + 0.5) * dem1.pixel_width
+    ys = dem1.y_origin + (win1.yoff + rows + 0.5) * dem1.pixel_height
     
-    ## Generate random points within data extents of DEMs
-    random_pts = random_points_within(num_pts, dem1_bb, dem2_bb)
-    
-    geoms = []
-    dem1_vals = []
-    dem2_vals = []
-    differences = []
+    return xs, ys
+
+
+def sample_points(dem1_path, dem2_path, num_pts=1000, from_pixels=False, mode='uniform',
+                  seed=None):
+    '''
+    Samples num_pts from dem1 and dem2 and returns the values, as well as 
+    difference of dem1 - dem2, as PointSamples (columns x, y, z1, z2, diff)
+    from_pixels: pick points from the valid overlapping pixels rather than
+                 within the data extents of the DEMs (requires the same grid)
+    mode: how points are spread, 'uniform', 'stratified' or 'poisson'
+    seed: seed or numpy Generator for reproducible points
+    '''
+    # Only read headers, pixels are read for the sample points
+    dem1 = Raster(dem1_path, lazy=True)
+    dem2 = Raster(dem2_path, lazy=True)
     
-    ## Sample z-values of DEMs at both points
-    for i, pt in enumerate(random_pts):
-        # Determine pixel locations using DEM Geotransform 
-        px1 = int((pt.x - dem1_gt[0]) / dem1_gt[1])
-        py1 = int((pt.y - dem1_gt[3]) / dem1_gt[5])
-        
-        px2 = int((pt.x - dem2_gt[0]) / dem2_gt[1])
-        py2 = int((pt.y - dem2_gt[3]) / dem2_gt[5])
-        
+    if from_pixels:
+        xs, ys = random_valid_points(num_pts, dem1, dem2, mode=mode, seed=seed)
+    else:
+        ## Get extents of DEMs exluding NoData
+        dem1_bb = raster_bounds(dem1_path)
+        dem2_bb = raster_bounds(dem2_path)
+#        bb_gdf = gpd.GeoDataFrame(geometry=[dem1_bb, dem2_bb])
+#        bb_gdf.to_file(r'V:\pgc\data\scratch\jeff\brash_island\dem\pc_align\dem_bb.shp', driver='ESRI Shapefile')
         
-        dem1_val = dem1[py1][px1]
-        dem2_val = dem2[py2][px2]
-        
-        diff = dem1_val - dem2_val
-        
-        # Append to list for creating geodataframe
-        geoms.append(Point(pt.x, pt.y))
-        dem1_vals.append(dem1_val)
-        dem2_vals.append(dem2_val)
-        differences.append(diff)
+        ## Generate random points within data extents of DEMs
+        xs, ys = random_points_within(num_pts, dem1_bb, dem2_bb, as_arrays=True, mode=mode,
+                                      seed=seed)
+    
+    ## Sample z-values of DEMs at all points, each DEM at its own pixels, and
+    ## drop points where either is nodata
+    vals = RasterStack([dem1, dem2]).ReadPoints(ys, xs)
+    keep = ~np.ma.getmaskarray(vals).any(axis=0)
+    xs, ys = xs[keep], ys[keep]
+    dem1_vals, dem2_vals = vals.data[:, keep]
     
-    print('Final number of sample points (ignoring NoData pts): {}'.format(len(differences)))
-    ## Create geodataframe of points with elevation 1, elevation 2, and difference
-    gdf = gpd.GeoDataFrame({'DEM1_value':dem1_vals, 'DEM2_value':dem2_vals, 'Diff':differences},
-                           geometry=geoms)
+    ## Keep points, elevation 1, elevation 2 and difference as columns, geometries
+    ## are only built if the samples are written out
+    samples = PointSamples(xs, ys, dem1_vals, dem2_vals, crs=dem1.prj.ExportToWkt())
+    print('Final number of sample points (ignoring NoData pts): {}'.format(len(samples)))
     
-    return gdf
+    return samples
 
 
 def normalize(vals, norm_min, norm_max):
@@ -180,8 +204,24 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--plot', type=str,
                         help='Option path to save plots: histogram of differences, scatter of values, map of sample points')
     parser.add_argument('-w', '--write_shp', type=str,
-                        help='Optional path to write shapefile of sample points')
-    
+                        help='''Optional path to write sample points to, as GeoPackage (.gpkg),
+                        GeoParquet (.parquet) or shapefile (.shp) by extension''')
+    parser.add_argument('--from_pixels', action='store_true',
+                        help='''Pick sample points from the pixels where both DEMs are valid,
+                        rather than within their data extents. DEMs must be on the same grid.''')
+    parser.add_argument('--mode', type=str, default='uniform', choices=MODES,
+                        help='''How sample points are spread: uniform random, stratified on a grid,
+                        or poisson (no two points closer than a minimum distance). Default uniform''')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for the random sample points, for reproducible results.')
+    parser.add_argument('--num_boot', type=int, default=1000,
+                        help='Number of bootstrap resamples for the RMSE confidence interval. Default 1000')
+    parser.add_argument('--ci_width', type=float, default=None,
+                        help='''Keep sampling until the 95%% confidence interval of the RMSE is
+                        narrower than this, starting from num_pts.''')
+    parser.add_argument('--max_pts', type=int, default=1000000,
+                        help='Maximum number of sample points when using --ci_width. Default 1000000')
+
     args = parser.parse_args()
     
     
@@ -189,17 +229,39 @@ if __name__ == '__main__':
     num_pts = args.num_pts if args.num_pts else 1000
 
     # Sample DEMs at random points
-    gdf = sample_points(args.dem1_path, args.dem2_path, num_pts=num_pts)
+    rng = get_rng(args.seed)
+    if args.ci_width:
+        ## Keep sampling until the confidence interval is narrow enough
+        draws = []
+        def draw_diffs(k):
+            draws.append(sample_points(args.dem1_path, args.dem2_path, num_pts=k,
+                                       from_pixels=args.from_pixels, mode=args.mode, seed=rng))
+            return draws[-1].diff
+        _diffs, _rmse, (ci_lower, ci_upper) = adaptive_rmse(draw_diffs, args.ci_width, n=num_pts,
+                                                            max_n=args.max_pts, num_boot=args.num_boot,
+                                                            seed=rng)
+        samples = PointSamples.concat(draws)
+    else:
+        samples = sample_points(args.dem1_path, args.dem2_path, num_pts=num_pts,
+                                from_pixels=args.from_pixels, mode=args.mode, seed=rng)
+        ci_lower, ci_upper = bootstrap_rmse(samples.diff, num_boot=args.num_boot, seed=rng)
 
     ## Calculate RMSE
-    rmse_val = calc_rmse(list(gdf['DEM1_value']), list(gdf['DEM2_value']))    
+    rmse_val = np.sqrt(np.mean(samples.diff.astype(np.float64)**2))
     print('\nRMSE: {:.3}'.format(rmse_val))
+    print('95% CI: {:.3} - {:.3} ({} points)'.format(ci_lower, ci_upper, len(samples)))
+    ## Robust to blunders (water, glaciers, etc.)
+    robust = robust_summary(samples.diff)
+    print('Median: {:.3}  NMAD: {:.3}'.format(robust['median'], robust['nmad']))
+    print('Percentiles: {}'.format('  '.join('{}: {:.3}'.format(k, v) for k, v in robust.items()
+                                             if k.startswith('p'))))
     
     if args.write_shp:
         shp_path = os.path.abspath(args.write_shp)
-        gdf.to_file(shp_path, driver='ESRI Shapefile')
+        samples.write(shp_path)
     
     if args.plot:
+        gdf = samples.to_dataframe()
         #### Plot
         plt.style.use('ggplot')
         fig, axes = plt.subplots(nrows=1, ncols=3, figsize=(14,8))
@@ -223,8 +285,8 @@ if __name__ == '__main__':
         cmap ='RdYlGn_r'
         gdf['abs_diff'] = abs(gdf['Diff'])
         gdf.sort_values(by='abs_diff', inplace=True)
-        gdf.plot(column='abs_diff', cmap=cmap, markersize=normalize(gdf['abs_diff'], 0, 10), 
-                 alpha=1, ax=axes[2])
+        gdf.plot(x='x', y='y', kind='scatter', c='abs_diff', cmap=cmap, colorbar=False,
+                 s=normalize(gdf['abs_diff'], 0, 10), alpha=1, ax=axes[2])
 
         axes[2].set_xticklabels([])
         axes[2].set_yticklabels([])
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Stack of rasters (e.g. DEMs of the same area) read on a common grid over
+their intersection. Rasters on the grid are read directly from their own
+window, others are resampled on the fly, so N rasters can be read as
+co-registered blocks.
+"""
+
+import numpy as np
+
+from RasterWrapper import Raster, Window
+
+
+class RasterStack():
+    '''
+    Rasters on a common grid covering the intersection of their extents.
+    The grid has the origin of the first raster, snapped inward to whole
+    pixels, and its pixel size (or resolution). Rasters must be in the same
+    coordinate system.
+    '''
+
+    def __init__(self, rasters, resolution=None, method='bilinear', **kwargs):
+        '''
+        rasters: list of Raster objects and/or paths
+        resolution: pixel size of the common grid, defaults to that of the
+                    first raster
+        method: resampling of rasters that are not on the common grid,
+                'nearest', 'bilinear' or 'cubic' (see Raster.SamplePoints)
+        kwargs: passed to Raster for rasters given as paths, lazy by default
+        '''
+        kwargs.setdefault('lazy', True)
+        self.rasters = [r if isinstance(r, Raster) else Raster(r, **kwargs) for r in rasters]
+        self.method = method
+
+        ref = self.rasters[0]
+        self.pixel_width = resolution if resolution else ref.pixel_width
+        self.pixel_height = -abs(resolution) if resolution else ref.pixel_height
+
+        ## Intersection of the extents of all rasters
+        ulx = max(r.x_origin for r in self.rasters)
+        uly = min(r.y_origin for r in self.rasters)
+        lrx = min(r.x_origin + r.pixel_width * r.x_sz for r in self.rasters)
+        lry = max(r.y_origin + r.pixel_height * r.y_sz for r in self.rasters)
+
+        ## Snap inward to the grid of the first raster
+        xoff = int(np.ceil((ulx - ref.x_origin) / self.pixel_width - 1e-6))
+        yoff = int(np.ceil((uly - ref.y_origin) / self.pixel_height - 1e-6))
+        xend = int(np.floor((lrx - ref.x_origin) / self.pixel_width + 1e-6))
+        yend = int(np.floor((lry - ref.y_origin) / self.pixel_height + 1e-6))
+        if xend <= xoff or yend <= yoff:
+            raise ValueError('Rasters do not overlap.')
+
+        self.x_origin = ref.x_origin + xoff * self.pixel_width
+        self.y_origin = ref.y_origin + yoff * self.pixel_height
+        self.x_sz = xend - xoff
+        self.y_sz = yend - yoff
+        self.geotransform = (self.x_origin, self.pixel_width, 0, self.y_origin, 0, self.pixel_height)
+
+        ## Window of each raster covering the grid, None if it must be resampled
+        self.windows = [self.member_window(r) for r in self.rasters]
+
+
+    def __len__(self):
+        return len(self.rasters)
+
+
+    def member_window(self, raster):
+        '''
+        Returns the Window of raster covering the common grid if raster has
+        the same pixel size and its pixels line up with the grid, else None.
+        '''
+        if not (np.isclose(raster.pixel_width, self.pixel_width) and
+                np.isclose(raster.pixel_height, self.pixel_height)):
+            return None
+        xoff = (self.x_origin - raster.x_origin) / raster.pixel_width
+        yoff = (self.y_origin - raster.y_origin) / raster.pixel_height
+        if not (np.isclose(xoff, round(xoff), atol=1e-3) and np.isclose(yoff, round(yoff), atol=1e-3)):
+            return None
+
+        return Window(int(round(xoff)), int(round(yoff)), self.x_sz, self.y_sz)
+
+
+    def ReadMember(self, i, xoff, yoff, xsize, ysize, band=1, cache=False):
+        '''
+        Reads a window of the common grid from the i-th raster, resampling if
+        it is not on the grid. Returns a masked array, masked where nodata.
+        '''
+        raster = self.rasters[i]
+        member_win = self.windows[i]
+        if member_win is not None:
+            arr = raster.ReadWindow(member_win.xoff + xoff, member_win.yoff + yoff, xsize, ysize,
+                                    band=band, cache=cache)
+            return np.ma.masked_array(arr, mask=raster.is_nodata(arr))
+
+        cols, rows = np.meshgrid(xoff + np.arange(xsize) + 0.5, yoff + np.arange(ysize) + 0.5)
+        ## SamplePoints places pixel values at their upper left corners, shift
+        ## by half a pixel to sample between pixel centers
+        xs = self.x_origin + cols.ravel() * self.pixel_width - raster.pixel_width / 2
+        ys = self.y_origin + rows.ravel() * self.pixel_height - raster.pixel_height / 2
+        values = raster.SamplePoints(ys, xs, method=self.method, band=band)
+
+        return values.reshape(ysize, xsize)
+
+
+    def ReadWindow(self, xoff, yoff, xsize, ysize, band=1, cache=False):
+        '''
+        Reads a window of the common grid from all rasters as a masked array
+        of (rasters, rows, cols).
+        '''
+        return np.ma.stack([self.ReadMember(i, xoff, yoff, xsize, ysize, band=band, cache=cache)
+                            for i in range(len(self.rasters))])
+
+
+    def block_windows(self, block_shape=None, band=1):
+        '''
+        Windows covering the common grid. Block boundaries line up with the
+        native blocks of the first raster when it is on the grid.
+        block_shape: (rows, cols), defaults to the native block size of the
+                     first raster, with strips grouped to about a million pixels
+        '''
+        ref = self.rasters[0]
+        if block_shape is None:
+            bx_sz, by_sz = ref.GetBand(band).GetBlockSize()
+            if by_sz < 64:
+                block_shape = (max(by_sz, 1024**2 // max(bx_sz, 1)), bx_sz)
+            else:
+                block_shape = (by_sz, bx_sz)
+        rows, cols = block_shape
+        ref_win = self.windows[0]
+        x0, y0 = (ref_win.xoff, ref_win.yoff) if ref_win is not None else (0, 0)
+
+        windows = []
+        for ystart in range(-(y0 % rows), self.y_sz, rows):
+            for xstart in range(-(x0 % cols), self.x_sz, cols):
+                xoff = max(xstart, 0)
+                yoff = max(ystart, 0)
+                windows.append(Window(xoff, yoff, min(xstart + cols, self.x_sz) - xoff,
+                                      min(ystart + rows, self.y_sz) - yoff))
+
+        return windows
+
+
+    def iter_blocks(self, block_shape=None, band=1):
+        '''
+        Iterates over the common grid in blocks, yielding (window, array) where
+        array is a masked array of (rasters, rows, cols) of co-registered values,
+        masked where nodata.
+        '''
+        for window in self.block_windows(block_shape=block_shape, band=band):
+            yield window, self.ReadWindow(*window, band=band)
+
+
+    def ReadPoints(self, ys, xs, band=1):
+        '''
+        Gets the value of the pixel containing each point from every raster,
+        each with its own geotransform (pixel values cover the pixel's area,
+        unlike Raster.SamplePoint(s), which round to the nearest upper left
+        corner). Points outside a raster get its edge pixel and are masked,
+        as are nodata values.
+        Returns a masked array of (rasters, points).
+        '''
+        ys = np.asarray(ys, dtype=np.float64).ravel()
+        xs = np.asarray(xs, dtype=np.float64).ravel()
+        values = []
+        for raster in self.rasters:
+            gt = raster.geotransform
+            px = np.floor((xs - gt[0]) / gt[1]).astype(np.int64)
+            py = np.floor((ys - gt[3]) / gt[5]).astype(np.int64)
+            outside = (px < 0) | (px >= raster.x_sz) | (py < 0) | (py >= raster.y_sz)
+            pixel_values = raster.ReadPixels(np.clip(py, 0, raster.y_sz - 1),
+                                             np.clip(px, 0, raster.x_sz - 1), band=band)
+            values.append(np.ma.masked_array(pixel_values, mask=outside | raster.is_nodata(pixel_values)))
+
+        return np.ma.stack(values)
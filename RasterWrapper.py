@@ -6,9 +6,22 @@ Created on Fri Jul 19 10:20:36 2019
 
 """
 
-from osgeo import gdal, osr, ogr
+from osgeo import gdal, gdal_array, osr, ogr
 import numpy as np
+import collections
 import logging
+import os
+from scipy import ndimage
+
+from dataset_pool import close_dataset, open_dataset
+from tile_cache import file_identity, get_tile_cache
+
+
+## Window of pixels: offsets of upper left corner and size
+Window = collections.namedtuple('Window', ['xoff', 'yoff', 'xsize', 'ysize'])
+
+## Number of set bits in each byte value, for counting packed mask bits
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1)
 
 
 class Raster():
@@ -22,8 +35,35 @@ class Raster():
         -sample raster with window around point
     '''
     
-    def __init__(self, raster_path):
-        self.data_src = gdal.Open(raster_path)
+    def __init__(self, raster_path, lazy=False, use_cache=True, mmap=False, overview=None, resolution=None):
+        '''
+        raster_path: path to raster
+        lazy: set to True to only read the header when opening, pixels are then
+              read from the file as windows when needed and the full array is
+              only read the first time Array is accessed
+        use_cache: read windows through the shared block cache (see tile_cache)
+                   when the full array is not in memory
+        mmap: set to True to memory map the pixel data instead of reading it,
+              for uncompressed GeoTIFF and ENVI files. Array is then a read-only
+              np.memmap for striped layouts, tiled layouts are read block by
+              block from the mapped tiles. Falls back to GDAL reads (as lazy)
+              when the layout does not allow it.
+        overview: decimation factor of an overview to read from instead of the
+                  full resolution raster (e.g. 2, 4, 8, ..., 64 as built by
+                  batch_compute_stats.create_ovr). The closest available
+                  overview is used.
+        resolution: target pixel size in the units of the raster, the coarsest
+                    overview that is not coarser than this is used
+        All reads, sampling and the size and geotransform of the object are
+        then those of the overview.
+        '''
+        self.raster_path = raster_path
+        self.lazy = lazy
+        self.use_cache = use_cache
+        self.mmap = mmap
+        self.data_src = open_dataset(raster_path)
+        ## Identifies this version of the file in the tile cache
+        self.file_id = file_identity(raster_path)
         self.geotransform = self.data_src.GetGeoTransform()
         
         self.prj = osr.SpatialReference()
@@ -32,6 +72,21 @@ class Raster():
         self.x_sz = self.data_src.RasterXSize
         self.y_sz = self.data_src.RasterYSize
         
+        ## Overview to read from, None for full resolution
+        self.overview_index = select_overview(self.data_src, overview=overview, resolution=resolution)
+        if self.overview_index is not None:
+            ovr_band = self.GetBand(1)
+            gt = list(self.geotransform)
+            gt[1] = gt[1] * self.x_sz / ovr_band.XSize
+            gt[5] = gt[5] * self.y_sz / ovr_band.YSize
+            self.geotransform = tuple(gt)
+            self.x_sz = ovr_band.XSize
+            self.y_sz = ovr_band.YSize
+            if mmap:
+                logging.debug('Overviews are not memory mapped, reading with GDAL.')
+                mmap = False
+                self.mmap = False
+        
         self.x_origin = self.geotransform[0]
         self.y_origin = self.geotransform[3]
         
@@ -43,7 +98,276 @@ class Raster():
         
         ## Get the raster as an array
         ## Defaults to band 1 -- use ReadArray() to return stack of multiple bands
-        self.Array = self.data_src.ReadAsArray()
+        ## In lazy mode the array is not read until Array is accessed
+        self._array = None
+        self._tile_memmaps = {}
+        ## Packed bit masks of valid pixels, by band, see ValidMask
+        self._valid_masks = {}
+        if mmap:
+            self._array = self.MemmapArray()
+        elif not lazy:
+            self._array = self.ReadFullArray()
+
+
+    @property
+    def Array(self):
+        '''
+        The full raster as an array. In lazy mode this reads the whole raster
+        the first time it is accessed and keeps it in memory.
+        '''
+        if self._array is None:
+            self._array = self.ReadFullArray()
+        return self._array
+
+    @Array.setter
+    def Array(self, array):
+        self._array = array
+        self._valid_masks = {}
+
+
+    def GetBand(self, band=1):
+        '''
+        Returns the GDAL band to read pixels from: the band itself, or its
+        overview when reading from an overview.
+        '''
+        src_band = self.data_src.GetRasterBand(band)
+        if self.overview_index is not None:
+            src_band = src_band.GetOverview(self.overview_index)
+
+        return src_band
+
+
+    def ReadFullArray(self):
+        '''
+        Reads all bands, as (rows, cols) for a single band or (bands, rows, cols).
+        '''
+        if self.overview_index is None:
+            return self.data_src.ReadAsArray()
+
+        band_arrays = [self.GetBand(band).ReadAsArray() for band in range(1, self.data_src.RasterCount + 1)]
+        if len(band_arrays) == 1:
+            return band_arrays[0]
+
+        return np.stack(band_arrays)
+
+
+    def MemmapLayout(self, band=1):
+        '''
+        Finds where the pixels of band are stored in the file. Returns
+        (offset, shape, dtype) for an np.memmap, where shape is (y_sz, x_sz)
+        when the rows are stored contiguously and
+        (num_tiles_y, num_tiles_x, tile_y_sz, tile_x_sz) when tiles are stored
+        contiguously in row order. Returns None if the pixels are compressed,
+        not stored contiguously or the format is not supported.
+        '''
+        if not os.path.isfile(self.raster_path):
+            return None
+        dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(self.dtype))
+        driver = self.data_src.GetDriver().ShortName
+
+        if driver == 'ENVI':
+            hdr_paths = [f for f in self.data_src.GetFileList() if f.lower().endswith('.hdr')]
+            hdr = read_envi_header(hdr_paths[0]) if hdr_paths else None
+            if hdr is None or (self.data_src.RasterCount > 1 and hdr.get('interleave', 'bsq') != 'bsq'):
+                return None
+            dtype = dtype.newbyteorder('>' if hdr.get('byte order', '0') == '1' else '<')
+            band_bytes = self.x_sz * self.y_sz * dtype.itemsize
+            offset = int(hdr.get('header offset', 0)) + (band - 1) * band_bytes
+
+            return offset, (self.y_sz, self.x_sz), dtype
+
+        if driver != 'GTiff':
+            return None
+        structure = self.data_src.GetMetadata('IMAGE_STRUCTURE') or {}
+        src_band = self.data_src.GetRasterBand(band)
+        if (structure.get('COMPRESSION') or
+            src_band.GetMetadataItem('NBITS', 'IMAGE_STRUCTURE') or
+            (self.data_src.RasterCount > 1 and structure.get('INTERLEAVE') != 'BAND')):
+            return None
+        dtype = dtype.newbyteorder(tiff_byte_order(self.raster_path))
+
+        ## Blocks must follow each other in the file, in row order
+        bx_sz, by_sz = src_band.GetBlockSize()
+        num_bx = (self.x_sz + bx_sz - 1) // bx_sz
+        num_by = (self.y_sz + by_sz - 1) // by_sz
+        block_bytes = bx_sz * by_sz * dtype.itemsize
+        offset = src_band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF')
+        if not offset or int(offset) == 0:
+            return None
+        offset = int(offset)
+        for i in range(num_bx * num_by):
+            by, bx = divmod(i, num_bx)
+            block_offset = src_band.GetMetadataItem('BLOCK_OFFSET_{}_{}'.format(bx, by), 'TIFF')
+            if block_offset is None or int(block_offset) != offset + i * block_bytes:
+                return None
+
+        if bx_sz == self.x_sz:
+            ## Striped, the last strip may be short
+            return offset, (self.y_sz, self.x_sz), dtype
+
+        return offset, (num_by, num_bx, by_sz, bx_sz), dtype
+
+
+    def MemmapArray(self):
+        '''
+        Memory maps the pixels of all bands. Returns a read-only np.memmap shaped
+        like ReadAsArray() if the rows of all bands are contiguous, otherwise
+        None. Bands stored as contiguous tiles are kept for block reads.
+        '''
+        layouts = [self.MemmapLayout(band) for band in range(1, self.data_src.RasterCount + 1)]
+        if any(layout is None for layout in layouts):
+            logging.debug('Pixel layout of {} does not allow memory mapping, '
+                          'reading with GDAL.'.format(self.raster_path))
+            return None
+
+        offset, shape, dtype = layouts[0]
+        if len(shape) == 4:
+            for band, (band_offset, band_shape, band_dtype) in enumerate(layouts, start=1):
+                self._tile_memmaps[band] = np.memmap(self.raster_path, dtype=band_dtype, mode='r',
+                                                     offset=band_offset, shape=band_shape)
+            return None
+
+        band_bytes = self.x_sz * self.y_sz * dtype.itemsize
+        if len(layouts) == 1:
+            return np.memmap(self.raster_path, dtype=dtype, mode='r', offset=offset, shape=shape)
+        if all(layout[0] == offset + i * band_bytes for i, layout in enumerate(layouts)):
+            return np.memmap(self.raster_path, dtype=dtype, mode='r', offset=offset,
+                             shape=(len(layouts),) + shape)
+
+        logging.debug('Bands of {} are not contiguous, reading with GDAL.'.format(self.raster_path))
+        return None
+
+
+    def clip_pixelWin(self, xmin, ymin, xmax, ymax):
+        '''
+        Clips a pixel window (xmin, ymin, xmax, ymax), where max values are
+        exclusive, to the extent of the raster.
+        '''
+        xmin = min(max(xmin, 0), self.x_sz)
+        ymin = min(max(ymin, 0), self.y_sz)
+        xmax = min(max(xmax, xmin), self.x_sz)
+        ymax = min(max(ymax, ymin), self.y_sz)
+
+        return xmin, ymin, xmax, ymax
+
+
+    def ReadWindow(self, xoff, yoff, xsize, ysize, band=1, cache=True):
+        '''
+        Reads a window of pixels. If the full array has already been read the
+        window is sliced from it, otherwise only the window is read from the file.
+        xoff, yoff: pixel coordinates of the upper left corner of the window
+        xsize, ysize: size of the window in pixels
+        band: band to read (1-based)
+        cache: set to False to read directly from the file rather than through
+               the tile cache, e.g. when each window is only read once
+        Raises IndexError if the window is not entirely within the raster.
+        '''
+        if (xoff < 0 or yoff < 0 or xsize < 0 or ysize < 0 or
+            xoff + xsize > self.x_sz or yoff + ysize > self.y_sz):
+            raise IndexError('Window {} not within raster of size {}'.format(
+                             (xoff, yoff, xsize, ysize), (self.x_sz, self.y_sz)))
+
+        if self._array is not None:
+            arr = self._array if self._array.ndim == 2 else self._array[band-1]
+            return arr[yoff:yoff+ysize, xoff:xoff+xsize]
+
+        if (self.use_cache and cache) or self._tile_memmaps:
+            return self.ReadBlocks(xoff, yoff, xsize, ysize, band=band)
+
+        return self.GetBand(band).ReadAsArray(xoff, yoff, xsize, ysize)
+
+
+    def ReadBlock(self, bx, by, band=1):
+        '''
+        Returns native block (bx, by) from the shared tile cache, reading it
+        on a miss. Blocks on the right and bottom edges may be partial.
+        '''
+        src_band = self.GetBand(band)
+        bx_sz, by_sz = src_band.GetBlockSize()
+        bx0 = bx * bx_sz
+        by0 = by * by_sz
+        if band in self._tile_memmaps:
+            ## Mapped tiles are not decoded, so are not cached
+            return self._tile_memmaps[band][by, bx, :self.y_sz - by0, :self.x_sz - bx0]
+
+        key = (self.raster_path, self.file_id, band, self.overview_index, bx, by)
+
+        return get_tile_cache().get(key, lambda: src_band.ReadAsArray(
+                                    bx0, by0, min(bx_sz, self.x_sz - bx0), min(by_sz, self.y_sz - by0)))
+
+
+    def ReadBlocks(self, xoff, yoff, xsize, ysize, band=1):
+        '''
+        Reads a window by assembling the native blocks of the raster that it
+        touches, getting each block from the shared tile cache.
+        '''
+        bx_sz, by_sz = self.GetBand(band).GetBlockSize()
+        window = np.empty((ysize, xsize), dtype=gdal_array.GDALTypeCodeToNumericTypeCode(self.dtype))
+        if xsize == 0 or ysize == 0:
+            return window
+
+        for by in range(yoff // by_sz, (yoff + ysize - 1) // by_sz + 1):
+            for bx in range(xoff // bx_sz, (xoff + xsize - 1) // bx_sz + 1):
+                block = self.ReadBlock(bx, by, band=band)
+                bx0 = bx * bx_sz
+                by0 = by * by_sz
+                ## Intersection of block and window
+                x0, x1 = max(xoff, bx0), min(xoff + xsize, bx0 + block.shape[1])
+                y0, y1 = max(yoff, by0), min(yoff + ysize, by0 + block.shape[0])
+                window[y0-yoff:y1-yoff, x0-xoff:x1-xoff] = block[y0-by0:y1-by0, x0-bx0:x1-bx0]
+
+        return window
+
+
+    def iter_blocks(self, halo=0, block_shape=None, band=1, window=None):
+        '''
+        Iterates over the raster in blocks aligned to the native block layout of
+        the file, yielding (window, array) pairs, so only one block needs to be
+        in memory at a time.
+        halo: number of pixels of overlap to include around each block, so that
+              neighbourhood operations are seamless across blocks. Arrays are
+              then (ysize + 2*halo, xsize + 2*halo), with the block itself at
+              array[halo:halo+ysize, halo:halo+xsize]. Halo pixels past the edge
+              of the raster repeat the edge values (as cv2.BORDER_REPLICATE).
+        block_shape: (rows, cols) of blocks, rounded up to a multiple of the
+                     native block size. Defaults to the native block size, with
+                     strips grouped to about a million pixels.
+        band: band to read (1-based)
+        window: optional Window to only iterate over part of the raster
+        '''
+        bx_sz, by_sz = self.GetBand(band).GetBlockSize()
+        if block_shape is None:
+            if by_sz < 64:
+                ## Striped layout, group strips
+                block_shape = (max(by_sz, 1024**2 // max(bx_sz, 1)), bx_sz)
+            else:
+                block_shape = (by_sz, bx_sz)
+        rows = -(-block_shape[0] // by_sz) * by_sz
+        cols = -(-block_shape[1] // bx_sz) * bx_sz
+
+        if window is None:
+            window = Window(0, 0, self.x_sz, self.y_sz)
+        win_x0, win_y0, win_x1, win_y1 = self.clip_pixelWin(window.xoff, window.yoff,
+                                                            window.xoff + window.xsize,
+                                                            window.yoff + window.ysize)
+
+        ## Start at the block boundary at or before the window
+        for y0 in range(win_y0 - win_y0 % rows, win_y1, rows):
+            for x0 in range(win_x0 - win_x0 % cols, win_x1, cols):
+                xmin, ymin = max(x0, win_x0), max(y0, win_y0)
+                xmax, ymax = min(x0 + cols, win_x1), min(y0 + rows, win_y1)
+                block_window = Window(xmin, ymin, xmax - xmin, ymax - ymin)
+
+                ## Read block with halo, padding where the halo is past the raster
+                hx0, hy0, hx1, hy1 = self.clip_pixelWin(xmin - halo, ymin - halo, xmax + halo, ymax + halo)
+                array = self.ReadWindow(hx0, hy0, hx1 - hx0, hy1 - hy0, band=band, cache=False)
+                if halo:
+                    pad = ((hy0 - (ymin - halo), (ymax + halo) - hy1),
+                           (hx0 - (xmin - halo), (xmax + halo) - hx1))
+                    if any(any(p) for p in pad):
+                        array = np.pad(array, pad, mode='edge')
+
+                yield block_window, array
 
 
     def geo2pixel(self, geocoord):
@@ -76,7 +400,8 @@ class Raster():
         array referenced.
         """
         xmin, ymin, xmax, ymax = self.projWin2pixelWin(projWin)
-        self.arr_window = self.Array[ymin:ymax, xmin:xmax]
+        xmin, ymin, xmax, ymax = self.clip_pixelWin(xmin, ymin, xmax, ymax)
+        self.arr_window = self.ReadWindow(xmin, ymin, xmax-xmin, ymax-ymin)
         
         return self.arr_window
     
@@ -90,8 +415,8 @@ class Raster():
         num_bands = self.data_src.RasterCount
         ## For each band read as array and add to list
         band_arrays = []
-        for band in range(num_bands):
-            band_arr = self.data_src.GetRasterBand(band).ReadAsArray()
+        for band in range(1, num_bands + 1):
+            band_arr = self.GetBand(band).ReadAsArray()
             band_arrays.append(band_arr)
         
         ## If stacked is True, stack bands and return
@@ -109,27 +434,37 @@ class Raster():
             return band_arrays
             
         
-    def WriteArray(self, array, out_path):
+    def Writer(self, out_path, num_bands=1, dtype=None, nodata_val=None, **kwargs):
+        '''
+        Returns a RasterWriter for a new raster with the size, geotransform and
+        projection of the current raster object, to write to window by window.
+        dtype and nodata_val default to those of the current raster.
+        kwargs: passed to RasterWriter (tiled, compress, predictor, cog, ...)
+        '''
+        return RasterWriter(out_path, self.x_sz, self.y_sz, self.geotransform, self.prj.ExportToWkt(),
+                            dtype=dtype if dtype is not None else self.dtype,
+                            num_bands=num_bands,
+                            nodata_val=nodata_val if nodata_val is not None else self.nodata_val,
+                            **kwargs)
+
+
+    def WriteArray(self, array, out_path, **kwargs):
         '''
         Writes the passed array with the metadata of the current raster object
         as new raster.
+        array: 2-D array (rows, cols), or 3-D array (rows, cols, bands) as
+               returned by ReadStackedArray, each layer is written as a band
+        kwargs: passed to RasterWriter (tiled, compress, predictor, cog, ...)
         '''
         # Get dimensions of input array
+        if array.ndim == 2:
+            array = array[:, :, np.newaxis]
         rows, cols, depth = array.shape
         
-        # Create output file
-        fmt = 'GTiff'
-        driver = gdal.GetDriverByName(fmt)
-        dst_ds = driver.Create(out_path, self.x_sz, self.y_sz, 1, self.dtype)
-        dst_ds.SetGeoTransform(self.geotransform)
-        dst_ds.SetProjection(self.prj.ExportToWkt())
-
-        # Loop through each layer of array and right as band
-        for i in range(depth):        
-            dst_ds.GetRasterBand(i).WriteArray(array)
-            dst_ds.GetRasterBand(i).SetNoDataValue(self.nodata_val)
-        
-        dst_ds = None
+        # Loop through each layer of array and write as band
+        with self.Writer(out_path, num_bands=depth, **kwargs) as writer:
+            for i in range(depth):
+                writer.write(Window(0, 0, cols, rows), array[:, :, i], band=i+1)
         
         
     def SamplePoint(self, point):
@@ -143,7 +478,7 @@ class Raster():
         px = int(np.around((point[1] - self.geotransform[0]) / self.geotransform[1]))
         ## Handle point being out of raster bounds
         try:    
-            point_value = self.Array[py, px]
+            point_value = self.ReadWindow(px, py, 1, 1)[0, 0]
         except IndexError as e:
             logging.debug('Point not within raster bounds.')
             logging.debug(e)
@@ -151,6 +486,194 @@ class Raster():
         return point_value
     
     
+    def ReadPixels(self, rows, cols, band=1):
+        '''
+        Gets the values at arrays of pixel locations, which must be within the
+        raster. In lazy mode only the blocks containing the pixels are read.
+        rows, cols: integer arrays of pixel coordinates
+        '''
+        if self._array is not None:
+            arr = self._array if self._array.ndim == 2 else self._array[band-1]
+            return arr[rows, cols]
+
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(self.dtype)
+        if len(rows) == 0:
+            return np.empty(0, dtype=dtype)
+
+        if not (self.use_cache or self._tile_memmaps):
+            ## Read the window covering all the pixels
+            ymin, xmin = rows.min(), cols.min()
+            window = self.ReadWindow(int(xmin), int(ymin), int(cols.max() - xmin + 1),
+                                     int(rows.max() - ymin + 1), band=band)
+            return window[rows - ymin, cols - xmin]
+
+        ## Group pixels by the block they fall in and read each block once
+        bx_sz, by_sz = self.GetBand(band).GetBlockSize()
+        num_bx = (self.x_sz + bx_sz - 1) // bx_sz
+        block_ids = (rows // by_sz) * num_bx + (cols // bx_sz)
+        order = np.argsort(block_ids, kind='stable')
+        ids, starts = np.unique(block_ids[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+
+        values = np.empty(len(rows), dtype=dtype)
+        for block_id, start, end in zip(ids, starts, ends):
+            by, bx = divmod(int(block_id), num_bx)
+            block = self.ReadBlock(bx, by, band=band)
+            idx = order[start:end]
+            values[idx] = block[rows[idx] - by * by_sz, cols[idx] - bx * bx_sz]
+
+        return values
+
+
+    def SamplePoints(self, ys, xs, method='nearest', band=1):
+        '''
+        Samples the current raster object at arrays of points. Must be the
+        same coordinate system used by the raster object.
+        ys, xs: arrays of y and x geocoordinates
+        method: 'nearest', 'bilinear' or 'cubic'
+        Returns a masked array, masked where points are outside the raster or
+        any pixel used for the point is nodata. Nearest keeps the raster
+        data type, bilinear and cubic return float64.
+        '''
+        ys = np.asarray(ys, dtype=np.float64).ravel()
+        xs = np.asarray(xs, dtype=np.float64).ravel()
+        ## Fractional pixel coordinates, integer values are the same as SamplePoint
+        fy = (ys - self.geotransform[3]) / self.geotransform[5]
+        fx = (xs - self.geotransform[0]) / self.geotransform[1]
+
+        ## Points outside raster bounds
+        py = np.around(fy)
+        px = np.around(fx)
+        inside = (py >= 0) & (py < self.y_sz) & (px >= 0) & (px < self.x_sz)
+
+        if method == 'nearest':
+            rows = py[inside].astype(np.int64)
+            cols = px[inside].astype(np.int64)
+            pixel_values = self.ReadPixels(rows, cols, band=band)
+            values = np.zeros(len(ys), dtype=pixel_values.dtype)
+            values[inside] = pixel_values
+            mask = ~inside
+            mask[inside] = self.is_nodata(pixel_values)
+
+            return np.ma.masked_array(values, mask=mask)
+
+        ## Offsets and weights of the neighbouring pixels in each direction
+        fy = fy[inside]
+        fx = fx[inside]
+        y0 = np.floor(fy)
+        x0 = np.floor(fx)
+        if method == 'bilinear':
+            y_offsets, y_weights = (0, 1), linear_weights(fy - y0)
+            x_offsets, x_weights = (0, 1), linear_weights(fx - x0)
+        elif method == 'cubic':
+            y_offsets, y_weights = (-1, 0, 1, 2), cubic_weights(fy - y0)
+            x_offsets, x_weights = (-1, 0, 1, 2), cubic_weights(fx - x0)
+        else:
+            raise ValueError('Unsupported sampling method: {}. Must be one of: '
+                             'nearest, bilinear, cubic'.format(method))
+
+        y0 = y0.astype(np.int64)
+        x0 = x0.astype(np.int64)
+        interp = np.zeros(len(fy), dtype=np.float64)
+        invalid = np.zeros(len(fy), dtype=bool)
+        for y_off, wy in zip(y_offsets, y_weights):
+            ## Neighbours past the edge of the raster take the edge value
+            rows = np.clip(y0 + y_off, 0, self.y_sz - 1)
+            for x_off, wx in zip(x_offsets, x_weights):
+                cols = np.clip(x0 + x_off, 0, self.x_sz - 1)
+                pixel_values = self.ReadPixels(rows, cols, band=band)
+                weights = wy * wx
+                nodata = self.is_nodata(pixel_values)
+                invalid |= nodata & (weights != 0)
+                interp += np.where(nodata, 0, pixel_values) * weights
+
+        values = np.zeros(len(ys), dtype=np.float64)
+        values[inside] = interp
+        mask = ~inside
+        mask[inside] = invalid
+
+        return np.ma.masked_array(values, mask=mask)
+
+
+    def ValidMask(self, band=1):
+        '''
+        Packed bit mask of valid (not nodata) pixels of band, shape
+        (y_sz, ceil(x_sz / 8)) as from np.packbits(valid, axis=1). Built block
+        by block the first time it is requested and then kept, using 1 bit per
+        pixel instead of a bool or float copy of the raster.
+        '''
+        if band not in self._valid_masks:
+            packed = np.zeros((self.y_sz, (self.x_sz + 7) // 8), dtype=np.uint8)
+            ## Full width blocks so each row is packed in one piece
+            rows = self.GetBand(band).GetBlockSize()[1]
+            for window, array in self.iter_blocks(block_shape=(rows, self.x_sz), band=band):
+                packed[window.yoff:window.yoff+window.ysize] = np.packbits(~self.is_nodata(array), axis=1)
+            self._valid_masks[band] = packed
+
+        return self._valid_masks[band]
+
+
+    def ValidWindow(self, xoff, yoff, xsize, ysize, band=1, array=None):
+        '''
+        Boolean array of valid pixels in a window. Uses the packed mask if it
+        has been built (or the full array is in memory, where building it needs
+        no reads), otherwise checks the window values against nodata.
+        array: values of the window if already read
+        '''
+        if band in self._valid_masks or self._array is not None:
+            packed = self.ValidMask(band)
+            bits = np.unpackbits(packed[yoff:yoff+ysize, xoff // 8:(xoff + xsize + 7) // 8], axis=1)
+            return bits[:, xoff % 8:xoff % 8 + xsize].astype(bool)
+
+        if array is None:
+            array = self.ReadWindow(xoff, yoff, xsize, ysize, band=band)
+
+        return ~self.is_nodata(array)
+
+
+    def ValidArray(self, band=1):
+        '''
+        Boolean array of valid pixels for the whole band, unpacked from the
+        packed mask.
+        '''
+        return np.unpackbits(self.ValidMask(band), axis=1, count=self.x_sz).astype(bool)
+
+
+    def ValidCount(self, band=1, window=None):
+        '''
+        Number of valid (not nodata) pixels in band, or in a Window of it,
+        counted from the packed mask.
+        '''
+        if window is None:
+            return int(POPCOUNT[self.ValidMask(band)].sum())
+
+        return int(self.ValidWindow(window.xoff, window.yoff, window.xsize, window.ysize, band=band).sum())
+
+
+    def ReadMaskedWindow(self, xoff, yoff, xsize, ysize, band=1):
+        '''
+        Reads a window as a masked array, masked where pixels are nodata.
+        '''
+        array = self.ReadWindow(xoff, yoff, xsize, ysize, band=band)
+        valid = self.ValidWindow(xoff, yoff, xsize, ysize, band=band, array=array)
+
+        return np.ma.masked_array(array, mask=~valid)
+
+
+    def is_nodata(self, values):
+        '''
+        Returns boolean array, True where values are the raster's nodata
+        value (or NaN).
+        '''
+        nodata = np.zeros(np.shape(values), dtype=bool)
+        if self.nodata_val is not None:
+            nodata |= values == self.nodata_val
+        if np.issubdtype(np.asarray(values).dtype, np.floating):
+            nodata |= np.isnan(values)
+
+        return nodata
+
+
     def SampleWindow(self, center_point, window_size, agg='mean', grow_window=False, max_grow=100000):
         '''
         Samples the current raster object using a window centered 
@@ -198,34 +721,32 @@ class Raster():
             growing = True
             while growing == True:
                 ymin, ymax, xmin, xmax = window_bounds(window_size, py, px)
-                window = self.Array[ymin:ymax, xmin:xmax].astype(np.float32)
-                window = np.where(window==-9999.0, np.nan, window)
-                
-                ## Test for window with all nans to avoid getting 0's for all nans
-                # Returns an array of True/False where True is valid values
-                window_valid = window == window
+                xmin, ymin, xmax, ymax = self.clip_pixelWin(xmin, ymin, xmax, ymax)
+                window = self.ReadMaskedWindow(xmin, ymin, xmax-xmin, ymax-ymin)
                 
-                if True in window_valid:
+                ## Test for window with no valid values to avoid getting 0's
+                if window.count() > 0:
                     ## Window contains at least one valid value, do aggregration
                     agg_lut = {
-                        'mean': np.nanmean(window),
-                        'sum': np.nansum(window),
-                        'min': np.nanmin(window),
-                        'max': np.nanmax(window)
+                        'mean': np.ma.mean,
+                        'sum': np.ma.sum,
+                        'min': np.ma.min,
+                        'max': np.ma.max
                         }
-                    window_agg = agg_lut[agg]
+                    window_agg = agg_lut[agg](window.astype(np.float32))
                     
                     # Do not grow if valid values found
                     growing = False
                     
                 else:
-                    ## Window all nan's, return nan value (arbitratily picking -9999)
+                    ## Window all no data, return no data value (-9999 if raster has none)
                     # If grow_window is True, increase window (y+2, x+2)
-                    if grow_window == True:
-                        window_size = (window_size[0]+2, window_size[1]+2)
+                    next_size = (window_size[0]+2, window_size[1]+2)
+                    if grow_window == True and next_size[0] * next_size[1] <= max_grow:
+                        window_size = next_size
                     # If grow_window is False, return no data and exit while loop
                     else:
-                        window_agg = -9999
+                        window_agg = self.nodata_val if self.nodata_val is not None else -9999
                         growing = False
             
             
@@ -235,3 +756,374 @@ class Raster():
             window_agg = None
             
         return window_agg
+
+
+    def SampleWindows(self, centers, window_size, agg='mean', grow_window=False, max_grow=100000, band=1,
+                      tile_size=512):
+        '''
+        Samples the current raster object using windows centered on many points
+        at once. Window sums and counts come from summed area tables of the
+        region around the points, so each window is O(1) whatever its size.
+        Points are grouped by tile and each tile is read with a halo wide enough
+        for the largest window, so memory is bounded by the tile size however
+        spread out the points are.
+        centers: array of (y, x) in geocoordinates, shape (n, 2)
+        window_size: tuple of (y_size, x_size) as number of pixels (must be odd)
+        agg: type of aggregation, mean, sum, min, max or count (of valid pixels)
+        grow_window: set to True to increase the size of each window (y+2, x+2)
+                     until a valid value is included in it
+        max_grow: the maximum area (x * y) a window will grow to
+        tile_size: size in pixels of the tiles points are grouped by
+        Returns a masked array, masked where the center is outside the raster,
+        the window has no valid values or would grow past max_grow.
+        '''
+        if agg not in ('mean', 'sum', 'min', 'max', 'count'):
+            raise ValueError('Unsupported aggregation: {}'.format(agg))
+
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        py = np.around((centers[:, 0] - self.geotransform[3]) / self.geotransform[5])
+        px = np.around((centers[:, 1] - self.geotransform[0]) / self.geotransform[1])
+        inside = (py >= 0) & (py < self.y_sz) & (px >= 0) & (px < self.x_sz)
+
+        result = np.ma.masked_all(len(centers), dtype=np.float64)
+        if not inside.any():
+            return result
+        idx = np.flatnonzero(inside)
+        py = py[inside].astype(np.int64)
+        px = px[inside].astype(np.int64)
+
+        y_step = int(window_size[0] / 2)
+        x_step = int(window_size[1] / 2)
+        ## Largest number of pixels a window can grow by on each side
+        max_steps = 0
+        if grow_window:
+            while (window_size[0] + 2*(max_steps+1)) * (window_size[1] + 2*(max_steps+1)) <= max_grow:
+                max_steps += 1
+
+        ## Group points by tile
+        tiles = (py // tile_size) * (self.x_sz // tile_size + 1) + px // tile_size
+        order = np.argsort(tiles, kind='stable')
+        bounds = np.flatnonzero(np.diff(tiles[order])) + 1
+        for group in np.split(order, bounds):
+            window_agg, has_values = self._sample_windows_region(py[group], px[group], y_step, x_step,
+                                                                 max_steps, agg, grow_window, band)
+            result[idx[group][has_values]] = window_agg[has_values]
+
+        return result
+
+
+    def _sample_windows_region(self, py, px, y_step, x_step, max_steps, agg, grow_window, band):
+        '''
+        SampleWindows for a group of points (pixel rows and columns), reading
+        only the region covering their windows. Returns (window_agg, has_values).
+        '''
+        ## Read the region covering all windows
+        xmin, ymin, xmax, ymax = self.clip_pixelWin(px.min() - x_step - max_steps,
+                                                    py.min() - y_step - max_steps,
+                                                    px.max() + x_step + max_steps + 1,
+                                                    py.max() + y_step + max_steps + 1)
+        region = self.ReadWindow(xmin, ymin, xmax-xmin, ymax-ymin, band=band)
+        valid = self.ValidWindow(xmin, ymin, xmax-xmin, ymax-ymin, band=band, array=region)
+        py = py - ymin
+        px = px - xmin
+
+        ## Summed area tables of valid count and of values (offset by the mean
+        ## of the region to limit float error when differencing large sums)
+        offset = region[valid].mean() if valid.any() else 0.0
+        count_sat = summed_area_table(valid)
+        sum_sat = summed_area_table(np.where(valid, region - offset, 0))
+
+        ## Number of pixels each window grows by on each side
+        steps = np.zeros(len(py), dtype=np.int64)
+        if grow_window:
+            ## Pixels whose starting window contains a valid value
+            has_valid = ndimage.maximum_filter(valid.astype(np.uint8), size=(2*y_step + 1, 2*x_step + 1),
+                                               mode='constant', cval=0) > 0
+            if has_valid.any():
+                ## Growing a window by k pixels reaches a valid value when a
+                ## pixel with a valid starting window is within k (chessboard)
+                dist = ndimage.distance_transform_cdt(~has_valid, metric='chessboard')
+                steps = dist[py, px].astype(np.int64)
+            else:
+                steps[:] = max_steps + 1
+
+        ## Window totals
+        counts = window_total(count_sat, py, px, y_step + steps, x_step + steps)
+        sums = window_total(sum_sat, py, px, y_step + steps, x_step + steps)
+        has_values = (counts > 0) & (steps <= max_steps)
+
+        if agg == 'count':
+            window_agg = counts.astype(np.float64)
+        elif agg == 'sum':
+            window_agg = sums + counts * offset
+        elif agg == 'mean':
+            window_agg = sums / np.maximum(counts, 1) + offset
+        else:
+            window_agg = window_extremes(region, valid, py, px, y_step + steps, x_step + steps, agg)
+
+        return window_agg, has_values
+
+
+class RasterWriter():
+    '''
+    Writes a new raster incrementally, one window of pixels at a time, so the
+    full array never has to be held in memory. Output is a (by default tiled
+    and compressed) GeoTIFF, or a Cloud Optimized GeoTIFF with cog=True.
+    Use as a context manager, or call close() when done.
+    '''
+
+    def __init__(self, out_path, x_sz, y_sz, geotransform, prj_wkt, dtype, num_bands=1,
+                 nodata_val=None, tiled=True, blocksize=512, compress='LZW', predictor=None,
+                 bigtiff='IF_SAFER', cog=False, num_threads='ALL_CPUS'):
+        '''
+        out_path: path to write raster to
+        x_sz, y_sz: size of raster in pixels
+        geotransform: GDAL geotransform
+        prj_wkt: projection as WKT
+        dtype: GDAL data type (e.g. gdal.GDT_Float32) or numpy dtype
+        num_bands: number of bands
+        nodata_val: no data value to set on each band
+        tiled: write tiles of blocksize x blocksize, otherwise strips
+        compress: GTiff compression, e.g. LZW, DEFLATE, ZSTD, or None
+        predictor: compression predictor, 2 for integers, 3 for floats
+        bigtiff: YES, NO, IF_NEEDED or IF_SAFER
+        cog: write a Cloud Optimized GeoTIFF. Blocks are written to a temporary
+             tiled GeoTIFF that is converted when the writer is closed.
+        num_threads: number of threads used to compress blocks, passed as the
+                     NUM_THREADS creation option (as GDAL_NUM_THREADS)
+        '''
+        if not isinstance(dtype, int):
+            dtype = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype).type)
+
+        self.out_path = out_path
+        self.x_sz = x_sz
+        self.y_sz = y_sz
+        self.num_bands = num_bands
+        self.cog = cog
+        self.num_threads = num_threads
+
+        self.creation_options = ['BIGTIFF={}'.format(bigtiff)]
+        if compress:
+            self.creation_options.append('COMPRESS={}'.format(compress))
+            if predictor:
+                self.creation_options.append('PREDICTOR={}'.format(predictor))
+        if num_threads:
+            self.creation_options.append('NUM_THREADS={}'.format(num_threads))
+
+        gtiff_options = list(self.creation_options)
+        if tiled or cog:
+            gtiff_options += ['TILED=YES',
+                              'BLOCKXSIZE={}'.format(blocksize),
+                              'BLOCKYSIZE={}'.format(blocksize)]
+        self.blocksize = blocksize
+
+        ## COG can only be created as a copy, so write blocks to a temporary GeoTIFF first
+        self.dst_path = out_path + '.tmp.tif' if cog else out_path
+
+        driver = gdal.GetDriverByName('GTiff')
+        self.dst_ds = driver.Create(self.dst_path, x_sz, y_sz, num_bands, dtype, options=gtiff_options)
+        self.dst_ds.SetGeoTransform(geotransform)
+        self.dst_ds.SetProjection(prj_wkt)
+        if nodata_val is not None:
+            for band in range(1, num_bands + 1):
+                self.dst_ds.GetRasterBand(band).SetNoDataValue(nodata_val)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def write(self, window, array, band=None):
+        '''
+        Writes array to window of the raster.
+        window: Window (xoff, yoff, xsize, ysize), only the offsets are used
+        array: 2-D array (rows, cols) or 3-D array (bands, rows, cols)
+        band: band to write a 2-D array to, defaults to 1. 3-D arrays are
+              written to bands 1..n
+        '''
+        if array.ndim == 3:
+            for i, band_array in enumerate(array, start=1):
+                self.dst_ds.GetRasterBand(i).WriteArray(band_array, int(window.xoff), int(window.yoff))
+        else:
+            self.dst_ds.GetRasterBand(band or 1).WriteArray(array, int(window.xoff), int(window.yoff))
+
+
+    def write_blocks(self, blocks, band=None):
+        '''
+        Writes each (window, array) pair of blocks, which can be a generator
+        so that only one block is in memory at a time.
+        '''
+        for window, array in blocks:
+            self.write(window, array, band=band)
+
+
+    def close(self):
+        '''
+        Flushes and closes the raster, converting it to COG if requested.
+        '''
+        if self.dst_ds is None:
+            return
+        self.dst_ds.FlushCache()
+        self.dst_ds = None
+
+        if self.cog:
+            cog_options = self.creation_options + ['BLOCKSIZE={}'.format(self.blocksize)]
+            gdal.Translate(self.out_path, self.dst_path, format='COG', creationOptions=cog_options)
+            gdal.GetDriverByName('GTiff').Delete(self.dst_path)
+
+        ## Handles and blocks of a previous file at out_path must not be used again
+        close_dataset(self.out_path)
+        get_tile_cache().invalidate(self.out_path)
+
+
+def overview_factors(data_src):
+    '''
+    Returns the decimation factors of the overviews of a GDAL dataset
+    (from band 1), in the order GDAL lists them.
+    '''
+    src_band = data_src.GetRasterBand(1)
+    factors = []
+    for i in range(src_band.GetOverviewCount()):
+        ovr_band = src_band.GetOverview(i)
+        factors.append(int(round(data_src.RasterXSize / ovr_band.XSize)))
+
+    return factors
+
+
+def select_overview(data_src, overview=None, resolution=None):
+    '''
+    Picks the overview index of data_src to read from.
+    overview: decimation factor, the overview with the closest factor is used
+    resolution: target pixel size, the coarsest overview with a pixel size no
+                larger than this is used
+    Returns None to read full resolution, i.e. when neither is given, no
+    overviews exist or full resolution is the best match.
+    '''
+    if overview is None and resolution is None:
+        return None
+    factors = overview_factors(data_src)
+    if not factors:
+        logging.warning('No overviews found for {}, reading full resolution.'.format(
+                        data_src.GetDescription()))
+        return None
+
+    if overview is not None:
+        if overview <= 1:
+            return None
+        return int(np.argmin([abs(np.log2(f) - np.log2(overview)) for f in factors]))
+
+    pixel_size = abs(data_src.GetGeoTransform()[1])
+    fits = [i for i, f in enumerate(factors) if f * pixel_size <= resolution]
+    if not fits:
+        return None
+
+    return max(fits, key=lambda i: factors[i])
+
+
+def linear_weights(t):
+    '''
+    Linear interpolation weights for the pixels at offsets 0 and 1 from
+    fractional distances t.
+    '''
+    return (1 - t, t)
+
+
+def cubic_weights(t, a=-0.5):
+    '''
+    Cubic convolution (Keys) interpolation weights for the pixels at offsets
+    -1, 0, 1 and 2 from fractional distances t.
+    '''
+    def near(d):
+        return (a + 2) * d**3 - (a + 3) * d**2 + 1
+
+    def far(d):
+        return a * d**3 - 5 * a * d**2 + 8 * a * d - 4 * a
+
+    return (far(1 + t), near(t), near(1 - t), far(2 - t))
+
+
+def summed_area_table(array):
+    '''
+    Summed area table (integral image) of array, with a leading row and column
+    of zeros, so the sum of array[y0:y1, x0:x1] is
+    sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0].
+    '''
+    dtype = np.int64 if array.dtype == bool else np.float64
+    sat = np.zeros((array.shape[0] + 1, array.shape[1] + 1), dtype=dtype)
+    np.cumsum(array, axis=0, dtype=dtype, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+
+    return sat
+
+
+def window_total(sat, py, px, y_step, x_step):
+    '''
+    Totals of windows centered on (py, px) extending y_step and x_step pixels
+    either side, clipped to the extent of the summed area table.
+    '''
+    y_sz = sat.shape[0] - 1
+    x_sz = sat.shape[1] - 1
+    y0 = np.clip(py - y_step, 0, y_sz)
+    y1 = np.clip(py + y_step + 1, 0, y_sz)
+    x0 = np.clip(px - x_step, 0, x_sz)
+    x1 = np.clip(px + x_step + 1, 0, x_sz)
+
+    return sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+
+
+def window_extremes(region, valid, py, px, y_step, x_step, agg):
+    '''
+    Min or max of the valid values in windows centered on (py, px). Windows of
+    the same size are looked up in a min/max filter of the region, unless there
+    are few of them, in which case they are sliced individually.
+    '''
+    fill = np.inf if agg == 'min' else -np.inf
+    func = np.min if agg == 'min' else np.max
+    filt = ndimage.minimum_filter if agg == 'min' else ndimage.maximum_filter
+    values = np.where(valid, region, fill).astype(np.float64)
+
+    extremes = np.full(len(py), np.nan)
+    sizes = np.stack([y_step, x_step], axis=1)
+    for y_st, x_st in np.unique(sizes, axis=0):
+        idx = np.flatnonzero((y_step == y_st) & (x_step == x_st))
+        area = (2*y_st + 1) * (2*x_st + 1)
+        if len(idx) * area < values.size:
+            for i in idx:
+                extremes[i] = func(values[max(py[i]-y_st, 0):py[i]+y_st+1,
+                                          max(px[i]-x_st, 0):px[i]+x_st+1])
+        else:
+            filtered = filt(values, size=(2*y_st + 1, 2*x_st + 1), mode='constant', cval=fill)
+            extremes[idx] = filtered[py[idx], px[idx]]
+
+    return extremes
+
+
+def tiff_byte_order(path):
+    '''
+    Returns '<' for little endian or '>' for big endian TIFF files.
+    '''
+    with open(path, 'rb') as f:
+        order = f.read(2)
+
+    return '<' if order == b'II' else '>'
+
+
+def read_envi_header(hdr_path):
+    '''
+    Reads the 'key = value' pairs of an ENVI .hdr file to a dict with lower
+    case keys, skipping multi-line {} values. Returns None if there is no header.
+    '''
+    if not os.path.isfile(hdr_path):
+        return None
+    hdr = {}
+    with open(hdr_path, 'r') as f:
+        for line in f:
+            if '=' in line and '{' not in line:
+                key, value = line.split('=', 1)
+                hdr[key.strip().lower()] = value.strip().lower()
+
+    return hdr
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Computes RMSE (and robust statistics) of every pair of DEMs in a pair file
+written by select_max_overlap_DEMs.py, in a pool of worker processes.
+Results are appended to a CSV as each pair finishes, so an interrupted run
+can be resumed.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import logging
+import os
+import time
+import zlib
+
+import numpy as np
+
+from RasterWrapper import Raster
+from RMSE_array_2 import DiffStats, bootstrap_rmse, progressive_RMSE, sample_random_points
+from robust_stats import dem_diff_robust_stats, robust_summary
+from spatial_sampling import get_rng
+
+
+FIELDS = ['dem1', 'dem2', 'method', 'count', 'rmse', 'mean', 'std', 'min', 'max',
+          'median', 'nmad', 'p5', 'p95', 'ci_lower', 'ci_upper', 'overview', 'status', 'seconds',
+          'error']
+
+
+def read_pairs(pairs_path):
+    '''
+    Reads a pair file (one pair per line: "path1, path2, ") into a
+    list of (path1, path2).
+    '''
+    pairs = []
+    with open(pairs_path, 'r') as f:
+        for line in f:
+            paths = [p.strip() for p in line.split(',') if p.strip()]
+            if not paths:
+                continue
+            if len(paths) != 2:
+                logging.warning('Skipping line that is not a pair: {}'.format(line.strip()))
+                continue
+            pairs.append(tuple(paths))
+
+    return pairs
+
+
+def completed_pairs(out_csv):
+    '''
+    Returns the set of (dem1, dem2, method) in an existing results CSV that
+    finished without error. method is '' for rows without one, which count
+    as done for any method.
+    '''
+    if not os.path.exists(out_csv):
+        return set()
+    with open(out_csv, 'r', newline='') as f:
+        return {(row['dem1'], row['dem2'], row.get('method') or '') for row in csv.DictReader(f)
+                if not row['error']}
+
+
+def upgrade_csv(out_csv):
+    '''
+    Rewrites an existing results CSV whose columns are not FIELDS (e.g. from
+    an older version) with FIELDS, leaving new columns empty, so rows can be
+    appended to it.
+    '''
+    with open(out_csv, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames == FIELDS:
+            return
+        rows = list(reader)
+    logging.warning('Rewriting {} with the current columns.'.format(out_csv))
+    with open(out_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS, restval='', extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def method_name(exact=False, progressive=False):
+    return 'progressive' if progressive else 'exact' if exact else 'sample'
+
+
+def pair_seed(seed, dem1_p, dem2_p):
+    '''
+    Seed for the sample points of one pair from the batch seed and the
+    paths, so each pair gets the same points whatever order it is run in.
+    '''
+    if seed is None:
+        return None
+    return [seed, zlib.crc32('{},{}'.format(dem1_p, dem2_p).encode())]
+
+
+def pair_stats(dem1_p, dem2_p, n=1000, exact=False, progressive=False, tolerance=0.05,
+               max_rmse=None, num_boot=1000, seed=None):
+    '''
+    Computes the statistics of dem1 - dem2 for one pair, from n random sample
+    points or every valid overlapping pixel if exact. Errors are returned
+    in the row rather than raised, so one bad pair does not stop a batch.
+    Sampled RMSEs get a bootstrap confidence interval of num_boot resamples.
+    seed: seed for the sample points and bootstrap (see pair_seed)
+    progressive: only estimate the RMSE, coarse to fine over the overviews
+                 (see RMSE_array_2.progressive_RMSE), with tolerance and
+                 max_rmse, recording the overview factor it stopped at
+    Returns a dict with the keys of FIELDS.
+    '''
+    row = dict.fromkeys(FIELDS, '')
+    method = method_name(exact, progressive)
+    row.update({'dem1': dem1_p, 'dem2': dem2_p, 'method': method})
+    start = time.time()
+    try:
+        if progressive:
+            rmse, status, estimates = progressive_RMSE(dem1_p, dem2_p, tolerance=tolerance,
+                                                       max_rmse=max_rmse)
+            row['status'] = status
+            if estimates:
+                row['overview'], row['rmse'], row['count'] = estimates[-1]
+        elif exact:
+            stats, hist = dem_diff_robust_stats(dem1_p, dem2_p)
+            robust = hist.summary(percentiles=(5, 95))
+        else:
+            dem1 = Raster(dem1_p, lazy=True)
+            dem2 = Raster(dem2_p, lazy=True)
+            rng = get_rng(seed)
+            samples = np.array(sample_random_points(dem1, dem2, n=n, seed=rng), dtype=np.float64)
+            diffs = samples[:, 0] - samples[:, 1]
+            stats = DiffStats()
+            stats.update(diffs)
+            robust = robust_summary(diffs, percentiles=(5, 95))
+            row['ci_lower'], row['ci_upper'] = bootstrap_rmse(diffs, num_boot=num_boot, seed=rng)
+        if not progressive:
+            row.update(stats.summary())
+            row.update({k: robust[k] for k in ('median', 'nmad', 'p5', 'p95')})
+    except Exception as e:
+        logging.error('Failed {} - {}: {}'.format(dem1_p, dem2_p, e))
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+    row['seconds'] = round(time.time() - start, 3)
+
+    return row
+
+
+def batch_RMSE(pairs_path, out_csv, n=1000, exact=False, workers=None, resume=True,
+               out_parquet=None, progressive=False, tolerance=0.05, max_rmse=None,
+               num_boot=1000, seed=None):
+    '''
+    Computes pair_stats for every pair in pairs_path using a pool of worker
+    processes, appending a row to out_csv as each pair finishes.
+    workers: number of processes, defaults to the number of CPUs
+    resume: skip pairs already in out_csv with the same method without an
+            error, otherwise out_csv is overwritten
+    out_parquet: optional path to also write the full results table to as Parquet
+    progressive, tolerance, max_rmse: quick coarse to fine RMSE for triage,
+                                      see pair_stats
+    num_boot: bootstrap resamples for the confidence interval of sampled RMSEs
+    seed: seed for reproducible sample points, each pair's points depend only
+          on the seed and its paths
+    Returns the number of pairs that failed.
+    '''
+    pairs = read_pairs(pairs_path)
+    method = method_name(exact, progressive)
+    if resume and os.path.exists(out_csv):
+        upgrade_csv(out_csv)
+    done = completed_pairs(out_csv) if resume else set()
+    todo = [p for p in pairs if p + (method,) not in done and p + ('',) not in done]
+    logging.info('{} pairs, {} already done, {} to compute.'.format(len(pairs), len(pairs) - len(todo),
+                                                                   len(todo)))
+
+    new_file = not (resume and os.path.exists(out_csv))
+    num_failed = 0
+    start = time.time()
+    with open(out_csv, 'w' if new_file else 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        if new_file:
+            writer.writeheader()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(pair_stats, dem1_p, dem2_p, n=n, exact=exact,
+                                   progressive=progressive, tolerance=tolerance, max_rmse=max_rmse,
+                                   num_boot=num_boot, seed=pair_seed(seed, dem1_p, dem2_p))
+                       for dem1_p, dem2_p in todo]
+            for i, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                row = future.result()
+                writer.writerow(row)
+                f.flush()
+                if row['error']:
+                    num_failed += 1
+                logging.info('{}/{} {} - {}: RMSE {} ({}s)'.format(i, len(todo),
+                             os.path.basename(row['dem1']), os.path.basename(row['dem2']),
+                             row['rmse'], row['seconds']))
+    logging.info('Finished {} pairs in {:.1f}s, {} failed.'.format(len(todo), time.time() - start,
+                                                                    num_failed))
+
+    if out_parquet:
+        import pandas as pd
+        pd.read_csv(out_csv).to_parquet(out_parquet, index=False)
+
+    return num_failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pairs_path', type=str,
+                        help='Path to pair file, e.g. filepath_pairs.txt from select_max_overlap_DEMs.py')
+    parser.add_argument('out_csv', type=str,
+                        help='Path to write results CSV to.')
+    parser.add_argument('-n', '--num_pts', type=int, default=1000,
+                        help='Number of sample points per pair. Default 1000')
+    parser.add_argument('--exact', action='store_true',
+                        help='Use every valid overlapping pixel rather than sample points.')
+    parser.add_argument('--progressive', action='store_true',
+                        help='''Quick RMSE estimate for triage, from the coarsest overviews
+                        refining one level at a time until it changes by less than tolerance.''')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='Relative change in RMSE between levels to stop at with --progressive. Default 0.05')
+    parser.add_argument('--max_rmse', type=float, default=None,
+                        help='With --progressive, reject pairs as soon as the RMSE estimate is over this.')
+    parser.add_argument('--num_boot', type=int, default=1000,
+                        help='Bootstrap resamples for the RMSE confidence interval of sampled pairs. Default 1000')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for reproducible sample points.')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes. Default: number of CPUs')
+    parser.add_argument('--no_resume', action='store_true',
+                        help='Recompute all pairs, overwriting out_csv.')
+    parser.add_argument('--parquet', type=str, default=None,
+                        help='Optional path to also write results to as Parquet.')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    batch_RMSE(args.pairs_path, os.path.abspath(args.out_csv), n=args.num_pts, exact=args.exact,
+               workers=args.workers, resume=not args.no_resume, out_parquet=args.parquet,
+               progressive=args.progressive, tolerance=args.tolerance, max_rmse=args.max_rmse,
+               num_boot=args.num_boot, seed=args.seed)
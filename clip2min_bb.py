@@ -8,7 +8,12 @@ to clip to given shapefile's extent, rounded to the nearest whole coordinate.
 """
 
 from osgeo import ogr, gdal, osr
-import os, logging, argparse
+import numpy as np
+import os, sys, logging, argparse, time
+import concurrent.futures
+
+from dataset_pool import open_dataset, close_dataset
+from raster_catalog import RasterCatalog
 
 
 ## Set up logging and exceptions
@@ -58,7 +63,7 @@ def raster_bounds(path):
     '''
     GDAL only version of getting bounds for a single raster.
     '''
-    src = gdal.Open(path)
+    src = open_dataset(path)
     gt = src.GetGeoTransform()
     ulx = gt[0]
     uly = gt[3]
@@ -68,17 +73,68 @@ def raster_bounds(path):
     return ulx, lry, lrx, uly
 
     
-def minimum_bounding_box(rasters):
+def data_bounds(path, max_pixels=None):
+    '''
+    Bounds of the valid (not nodata) data of a single raster, in the same order
+    as raster_bounds. Rows and columns with any valid data are found from the
+    valid mask at overview resolution (see raster_footprint.footprint_mask),
+    padded by one overview pixel so no valid full resolution pixel is cut, and
+    snapped out to the full resolution grid.
+    max_pixels: approximate size of the mask, defaults to raster_footprint.MAX_PIXELS
+    '''
+    ## Only needed for data extents, avoids loading rasterio and shapely otherwise
+    from raster_footprint import MAX_PIXELS, footprint_mask
+
+    valid, mask_gt = footprint_mask(path, max_pixels=max_pixels or MAX_PIXELS)
+    rows = np.flatnonzero(valid.any(axis=1))
+    cols = np.flatnonzero(valid.any(axis=0))
+    if len(rows) == 0:
+        raise ValueError('No valid data in {}'.format(path))
+    row0 = max(rows[0] - 1, 0)
+    row1 = min(rows[-1] + 2, valid.shape[0])
+    col0 = max(cols[0] - 1, 0)
+    col1 = min(cols[-1] + 2, valid.shape[1])
+
+    ## Snap to whole pixels of the full resolution raster, within its frame
+    src = open_dataset(path)
+    gt = src.GetGeoTransform()
+    xoff = max(int(np.floor((mask_gt[0] + col0 * mask_gt[1] - gt[0]) / gt[1])), 0)
+    xend = min(int(np.ceil((mask_gt[0] + col1 * mask_gt[1] - gt[0]) / gt[1])), src.RasterXSize)
+    yoff = max(int(np.floor((mask_gt[3] + row0 * mask_gt[5] - gt[3]) / gt[5])), 0)
+    yend = min(int(np.ceil((mask_gt[3] + row1 * mask_gt[5] - gt[3]) / gt[5])), src.RasterYSize)
+    ulx = gt[0] + xoff * gt[1]
+    lrx = gt[0] + xend * gt[1]
+    uly = gt[3] + yoff * gt[5]
+    lry = gt[3] + yend * gt[5]
+
+    return ulx, lry, lrx, uly
+
+
+def minimum_bounding_box(rasters, catalog=None, data_extent=False):
     '''
     Takes a list of DEMs (or rasters) and returns the minimum bounding box of all in
     the order of bounds specified for gdal.Translate.
     dems: list of dems
+    catalog: optional RasterCatalog (or path to one) to get bounds from, only
+             rasters that are new or changed since they were catalogued are opened
+    data_extent: use the extent of the valid data of each raster (see data_bounds)
+                 rather than the full frame, to clip off nodata collars. The
+                 catalog is not used for these.
     '''
+    if catalog is not None and not data_extent:
+        if isinstance(catalog, str):
+            with RasterCatalog(catalog) as cat:
+                return cat.minimum_bounding_box(rasters)
+        return catalog.minimum_bounding_box(rasters)
+
     ## Determine minimum bounding box
     ulxs, lrys, lrxs, ulys = list(), list(), list(), list()
     #geoms = list()
     for raster_p in rasters:
-        ulx, lry, lrx, uly = raster_bounds(raster_p)
+        if data_extent:
+            ulx, lry, lrx, uly = data_bounds(raster_p)
+        else:
+            ulx, lry, lrx, uly = raster_bounds(raster_p)
     #    geom_pts = [(ulx, lry), (lrx, lry), (lrx, uly), (ulx, uly)]
     #    geom = Polygon(geom_pts)
     #    geoms.append(geom)
@@ -98,26 +154,118 @@ def minimum_bounding_box(rasters):
     return projWin
 
 
-def translate_rasters(rasters, projWin, out_dir, out_suffix='_trans'):
+def projwin2srcwin(raster_ds, projWin):
     '''
-    Takes a list of rasters and translates (clips) them to the minimum bounding box
+    Converts a projWin [ulx, uly, lrx, lry] to a srcWin [xoff, yoff, xsize, ysize]
+    of whole pixels of raster_ds.
     '''
-    ## Translate (clip) to minimum bounding box
-    translated = {}
+    gt = raster_ds.GetGeoTransform()
+    ulx, uly, lrx, lry = projWin
+    xoff = int(round((ulx - gt[0]) / gt[1]))
+    yoff = int(round((uly - gt[3]) / gt[5]))
+    xsize = int(round((lrx - gt[0]) / gt[1])) - xoff
+    ysize = int(round((lry - gt[3]) / gt[5])) - yoff
+
+    return [xoff, yoff, xsize, ysize]
+
+
+def set_gdal_config(num_threads=None, cache_max=None, thread_local=False):
+    '''
+    Sets GDAL_NUM_THREADS, for the current thread only if thread_local, and
+    the size of the GDAL block cache in MB for the whole process. None leaves
+    a setting as it is.
+    '''
+    set_option = gdal.SetThreadLocalConfigOption if thread_local else gdal.SetConfigOption
+    if num_threads is not None:
+        set_option('GDAL_NUM_THREADS', str(num_threads))
+    if cache_max is not None:
+        ## GDAL_CACHEMAX is only read when the cache is first used, which may
+        ## already have happened (e.g. in a forked worker), so resize directly
+        gdal.SetCacheMax(cache_max * 1024**2)
+
+
+def translate_raster(raster_p, projWin, raster_op, virtual=False, num_threads=None):
+    '''
+    Translates (clips) one raster to projWin, writing raster_op, and closes
+    the output straight away.
+    num_threads: GDAL_NUM_THREADS for this job (e.g. for compression)
+    Returns a summary dict of src, dst, seconds and error (None if it worked).
+    '''
+    logging.info('Translating {}...'.format(raster_p))
+    start = time.time()
+    error = None
+    set_gdal_config(num_threads=num_threads, thread_local=True)
+    try:
+        raster_ds = open_dataset(raster_p)
+        ## Drop any pooled handle to a previous output before overwriting it
+        close_dataset(raster_op)
+        if virtual:
+            ## Only a window change, reference the source by whole pixels
+            out_ds = gdal.Translate(raster_op, raster_ds, format='VRT',
+                                    srcWin=projwin2srcwin(raster_ds, projWin))
+        else:
+            out_ds = gdal.Translate(raster_op, raster_ds, projWin=projWin)
+        ## Flush and close the output
+        del out_ds
+    except Exception as e:
+        logging.error('Failed to translate {}: {}'.format(raster_p, e))
+        error = str(e)
+    finally:
+        gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', None)
+
+    return {'src': raster_p, 'dst': raster_op, 'seconds': round(time.time() - start, 3),
+            'error': error}
+
+
+def translate_rasters(rasters, projWin, out_dir, out_suffix='_trans', virtual=False,
+                      workers=None, processes=False, num_threads=None, cache_max=None):
+    '''
+    Takes a list of rasters and translates (clips) them to the minimum bounding box,
+    several at once in a pool of threads (or processes).
+    virtual: write VRTs referencing the window of each source raster rather
+             than copying the pixels, these only take a few KB and readers of
+             them only read the clipped pixels from the sources. Use an out_dir
+             of /vsimem/ to keep them in memory.
+    workers: number of rasters to translate at once, defaults to the number of CPUs
+    processes: use a pool of processes rather than threads
+    num_threads: GDAL_NUM_THREADS for each job
+    cache_max: GDAL block cache size in MB, for each process if processes, otherwise
+               shared by all threads
+    Returns a dict of output name: summary (see translate_raster), outputs
+    are closed once written. Rasters that failed have an error in their summary.
+    '''
+    jobs = {}
+    ext = '.vrt' if virtual else '.tif'
     for raster_p in rasters:
-        if not out_dir:
-            out_dir == os.path.dirname(raster_p)
-        logging.info('Translating {}...'.format(raster_p))
-        raster_out_name = '{}_{}.tif'.format(os.path.split(raster_p)[0], out_suffix)
-        raster_op = os.path.join(out_dir, raster_out_name)
-        
-        raster_ds = gdal.Open(raster_p)
-        translated[raster_out_name] = gdal.Translate(raster_op, raster_ds, projWin=projWin)
+        raster_out_dir = out_dir if out_dir else os.path.dirname(raster_p)
+        raster_out_name = '{}{}{}'.format(os.path.splitext(os.path.basename(raster_p))[0],
+                                          out_suffix, ext)
+        jobs[raster_out_name] = (raster_p, os.path.join(raster_out_dir, raster_out_name))
+
+    workers = workers or min(len(jobs), os.cpu_count()) or 1
+    if processes:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=set_gdal_config,
+                                                      initargs=(None, cache_max))
+    else:
+        set_gdal_config(cache_max=cache_max)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    ## Translate (clip) to minimum bounding box
+    start = time.time()
+    with pool:
+        futures = {name: pool.submit(translate_raster, raster_p, projWin, raster_op, virtual=virtual,
+                                     num_threads=num_threads)
+                   for name, (raster_p, raster_op) in jobs.items()}
+        translated = {name: future.result() for name, future in futures.items()}
+    num_failed = sum(1 for summary in translated.values() if summary['error'])
+    logging.info('Translated {} rasters in {:.1f}s with {} workers, {} failed.'.format(
+                 len(translated), time.time() - start, workers, num_failed))
     
     return translated
 
 
-def clip2min_bb(src, out_dir, suffix=('.tif'), out_suffix='_trans'):
+def clip2min_bb(src, out_dir, suffix=('.tif'), out_suffix='_trans', virtual=False,
+                data_extent=False):
     '''
     Wrapper function to clip a number of rasters to a the minimum bounding box of all.
     src: list of raster paths and/or directories
@@ -125,13 +273,16 @@ def clip2min_bb(src, out_dir, suffix=('.tif'), out_suffix='_trans'):
              memory
     suffix: common suffix among rasters, can supply multiple as tuple
     out_suffix: suffix to append to output rasters.
+    virtual: write VRTs of the clipped windows rather than copies
+    data_extent: clip to the overlap of the valid data, not of the full rasters
     '''
     ## Get paths of rasters in src
     file_paths = parse_src([src], suffix=suffix)
     ## Get min bounding box of rasters
-    projWin = minimum_bounding_box(file_paths)
-    ## Translate rasters, returns dict of filepath: translated_raster
-    translated = translate_rasters(file_paths, projWin, out_dir, out_suffix=out_suffix)
+    projWin = minimum_bounding_box(file_paths, data_extent=data_extent)
+    ## Translate rasters, returns dict of output name: summary of output and timing
+    translated = translate_rasters(file_paths, projWin, out_dir, out_suffix=out_suffix,
+                                   virtual=virtual)
 
     return translated
     
@@ -148,7 +299,7 @@ def write_min_bb(projWin, out_dir, dems):
     out_path = os.path.join(out_dir, 'minimum_bb.shp')
     
     ## Get projection information from the first DEM provided
-    dem_ds = gdal.Open(dems[0])
+    dem_ds = open_dataset(dems[0])
     prj = dem_ds.GetProjection()
     srs = osr.SpatialReference()
     srs.ImportFromWkt(prj)
@@ -197,6 +348,23 @@ if __name__ == '__main__':
                         directory for each raster provided. Alternatively, can supply
                         /vsimem/ to not save rasters anywhere (in case of just wanting
                         shapefile of minimum bounding box.)''')
+    parser.add_argument('-d', '--data_extent', action='store_true',
+                        help='''Clip to the overlap of the valid data of the rasters, found at
+                        overview resolution, rather than of their full extents.''')
+    parser.add_argument('--catalog', type=str, default=None,
+                        help='''Optional raster catalog (SQLite, see raster_catalog.py) to get bounds
+                        from without opening the rasters. Created if it does not exist.''')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of rasters to translate at once. Default: number of CPUs')
+    parser.add_argument('--processes', action='store_true',
+                        help='Use processes rather than threads for translating.')
+    parser.add_argument('--num_threads', type=str, default=None,
+                        help='GDAL_NUM_THREADS for each raster, e.g. 2 or ALL_CPUS.')
+    parser.add_argument('--cache_max', type=int, default=None,
+                        help='GDAL block cache size in MB, per process with --processes.')
+    parser.add_argument('-v', '--vrt', action='store_true',
+                        help='''Write VRTs referencing the clipped window of each raster instead
+                        of GeoTIFF copies.''')
     
     args = parser.parse_args()
     
@@ -206,11 +374,19 @@ if __name__ == '__main__':
     out_dir = args.out_dir
     
     rasters = parse_src(src, suffix)
-    projWin = minimum_bounding_box(rasters)
-    translate_rasters(rasters, projWin, out_dir=out_dir)
+    projWin = minimum_bounding_box(rasters, catalog=args.catalog, data_extent=args.data_extent)
+    translated = translate_rasters(rasters, projWin, out_dir=out_dir, virtual=args.vrt,
+                                   workers=args.workers, processes=args.processes,
+                                   num_threads=args.num_threads, cache_max=args.cache_max)
 
     if write_shp == True:
         write_min_bb(projWin, out_dir, rasters)
+
+    failed = [summary['src'] for summary in translated.values() if summary['error']]
+    if failed:
+        logging.error('Failed to translate {} of {} rasters: {}'.format(len(failed), len(translated),
+                                                                      ', '.join(failed)))
+        sys.exit(1)
         
 
 
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of open GDAL dataset handles, shared by Raster and the helper functions
+that take paths, so batch jobs open each file roughly once.
+"""
+
+import collections
+import logging
+import os
+import threading
+
+from osgeo import gdal
+
+
+## Default maximum number of open datasets
+DEFAULT_MAX_OPEN = 64
+
+
+class DatasetPool():
+    '''
+    Thread-safe pool of open GDAL datasets keyed by path. Keeps at most max_open
+    datasets, closing the least recently used when the limit is reached.
+    A GDAL dataset must not be read from more than one thread at once, so each
+    thread gets its own handle to a path. Handles are also keyed by process,
+    forked workers keep the parent's thread ids but must not share its handles.
+    Closing drops the pool's reference, the file is closed by GDAL once no
+    other object (e.g. a Raster) holds the dataset.
+    '''
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN):
+        self.max_open = max_open
+        self.hits = 0
+        self.misses = 0
+        self._datasets = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            ## The lock may be held by another thread of the parent when forking
+            os.register_at_fork(after_in_child=self._reset_lock)
+
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._datasets)
+
+
+    def open(self, path, update=False):
+        '''
+        Returns an open dataset for path, opening it if it is not in the pool.
+        update: open for update rather than read only
+        '''
+        key = (path, update, os.getpid(), threading.get_ident())
+        with self._lock:
+            ds = self._datasets.get(key)
+            if ds is not None:
+                self._datasets.move_to_end(key)
+                self.hits += 1
+                return ds
+            self.misses += 1
+
+        ## Open outside the lock so slow opens do not block other threads
+        ds = gdal.Open(path, gdal.GA_Update if update else gdal.GA_ReadOnly)
+        if ds is None:
+            return ds
+
+        with self._lock:
+            self._datasets[key] = ds
+            while len(self._datasets) > self.max_open:
+                self._datasets.popitem(last=False)
+
+        return ds
+
+
+    def close(self, path=None):
+        '''
+        Closes all handles to path, e.g. before it is overwritten, or all
+        datasets if no path is given.
+        '''
+        with self._lock:
+            if path is None:
+                self._datasets.clear()
+            else:
+                for key in [k for k in self._datasets if k[0] == path]:
+                    del self._datasets[key]
+
+
+    def resize(self, max_open):
+        with self._lock:
+            self.max_open = max_open
+            while len(self._datasets) > self.max_open:
+                self._datasets.popitem(last=False)
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'open': len(self._datasets),
+                    'max_open': self.max_open}
+
+
+    def log_stats(self, level=logging.INFO):
+        s = self.stats()
+        logging.log(level, 'Dataset pool: {} hits, {} misses, {} of {} datasets open'.format(
+                    s['hits'], s['misses'], s['open'], s['max_open']))
+
+
+## Pool shared by all tools in the process
+dataset_pool = DatasetPool()
+
+
+def open_dataset(path, update=False):
+    '''
+    Opens path through the shared dataset pool.
+    '''
+    return dataset_pool.open(path, update=update)
+
+
+def close_dataset(path=None):
+    dataset_pool.close(path)
+
+
+def set_max_open(max_open):
+    '''
+    Sets the maximum number of datasets kept open by the shared pool.
+    '''
+    dataset_pool.resize(max_open)
@@ -16,7 +16,7 @@ from osgeo import gdal
 from scipy.ndimage.filters import generic_filter
 
 ## Local libs
-from misc_utils.RasterWrapper import Raster
+from RasterWrapper import Raster
 
 gdal.UseExceptions()
 
@@ -79,3 +79,25 @@ def calc_tpi_dev(dem, size):
     tpi_dev = tpi / std_array
 
     return tpi_dev
+
+
+def calc_tpi_blocks(dem_path, out_path, size, **kwargs):
+    """
+    Out of core version of calc_tpi. Reads the DEM block by block with a halo of
+    half the kernel size and writes the TPI of each block to out_path, so peak
+    memory is bounded by the block size. Result matches calc_tpi on the full array.
+    dem_path: path to DEM
+    out_path: path to write TPI raster to
+    size: int, kernel size in x and y directions (square kernel)
+    kwargs: passed to RasterWriter (compress, predictor, cog, ...)
+    """
+    halo = size // 2
+    dem = Raster(dem_path, lazy=True)
+
+    def tpi_blocks():
+        for window, block in dem.iter_blocks(halo=halo):
+            tpi = calc_tpi(block.astype(np.float32), size)
+            yield window, tpi[halo:halo+window.ysize, halo:halo+window.xsize]
+
+    with dem.Writer(out_path, dtype=gdal.GDT_Float32, **kwargs) as writer:
+        writer.write_blocks(tpi_blocks())
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Interpolates error values at points (e.g. DEM - ICESat differences) onto a
+grid, tile by tile in a pool of threads, writing each tile straight to a
+tiled GeoTIFF so the full grid is never held in memory.
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal
+from scipy.interpolate import LinearNDInterpolator
+from scipy.spatial import cKDTree, Delaunay
+
+from RasterWrapper import RasterWriter, Window
+
+
+class IDWInterpolator():
+    '''
+    Inverse distance weighted interpolation from the k nearest points, found
+    with a KD-tree built once over all the points.
+    '''
+
+    def __init__(self, coords, values, k=8, power=2, max_dist=np.inf):
+        '''
+        coords: (n, 2) array of point x, y
+        values: n values at the points
+        k: number of nearest points to use
+        power: power of inverse distance weights
+        max_dist: points further than this are not used, cells with no
+                  points within max_dist are NaN
+        '''
+        self.tree = cKDTree(coords)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.k = min(k, len(self.values))
+        self.power = power
+        self.max_dist = max_dist
+
+
+    def __call__(self, xs, ys):
+        dist, idx = self.tree.query(np.column_stack([xs, ys]), k=self.k,
+                                    distance_upper_bound=self.max_dist)
+        if self.k == 1:
+            dist = dist[:, np.newaxis]
+            idx = idx[:, np.newaxis]
+        found = np.isfinite(dist)
+        ## Missing neighbours are given an index of n, use any value with zero weight
+        values = self.values[np.where(found, idx, 0)]
+        with np.errstate(divide='ignore'):
+            weights = np.where(found, 1 / dist**self.power, 0)
+        ## Cells on top of a point take its value
+        exact = dist == 0
+        on_point = exact.any(axis=1)
+        weights[on_point] = exact[on_point]
+        total = weights.sum(axis=1)
+        with np.errstate(invalid='ignore'):
+            return (weights * values).sum(axis=1) / np.where(total > 0, total, np.nan)
+
+
+class LinearInterpolator():
+    '''
+    Linear interpolation on a Delaunay triangulation of the points. The
+    triangulation is the expensive part and can be reused for other values
+    at the same points with with_values.
+    Cells outside the convex hull of the points are NaN.
+    '''
+
+    def __init__(self, coords, values, tri=None):
+        self.tri = tri if tri is not None else Delaunay(coords)
+        self.interp = LinearNDInterpolator(self.tri, np.asarray(values, dtype=np.float64))
+
+
+    def with_values(self, values):
+        return LinearInterpolator(None, values, tri=self.tri)
+
+
+    def __call__(self, xs, ys):
+        return self.interp(xs, ys)
+
+
+def grid_windows(x_sz, y_sz, tile_size):
+    '''
+    Windows of tile_size covering a grid of x_sz by y_sz.
+    '''
+    return [Window(xoff, yoff, min(tile_size, x_sz - xoff), min(tile_size, y_sz - yoff))
+            for yoff in range(0, y_sz, tile_size) for xoff in range(0, x_sz, tile_size)]
+
+
+def interpolate_tiles(interpolator, geotransform, windows, nodata=-9999, workers=None):
+    '''
+    Evaluates interpolator at the cell centers of each window in a pool of
+    threads, yielding (window, array) in order. At most a few tiles per
+    thread are held in memory at once.
+    '''
+    def interpolate_tile(window):
+        cols = window.xoff + np.arange(window.xsize) + 0.5
+        rows = window.yoff + np.arange(window.ysize) + 0.5
+        gx, gy = np.meshgrid(geotransform[0] + cols * geotransform[1],
+                             geotransform[3] + rows * geotransform[5])
+        values = interpolator(gx.ravel(), gy.ravel()).reshape(gx.shape)
+        values[np.isnan(values)] = nodata
+        return window, values.astype(np.float32)
+
+    workers = workers or os.cpu_count()
+    batch = 4 * workers
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for i in range(0, len(windows), batch):
+            for result in pool.map(interpolate_tile, windows[i:i + batch]):
+                yield result
+
+
+def error_surface(interpolator, out_path, bounds, resolution, prj_wkt, tile_size=512,
+                  nodata=-9999, workers=None, **kwargs):
+    '''
+    Writes the surface given by interpolator over bounds to a tiled GeoTIFF.
+    interpolator: IDWInterpolator, LinearInterpolator or any function of x, y arrays
+    bounds: (minx, miny, maxx, maxy) of the grid
+    resolution: cell size, in the units of bounds
+    prj_wkt: projection of the grid as WKT
+    tile_size: size of the tiles computed at once and of the GeoTIFF blocks
+    workers: number of threads, defaults to the number of CPUs
+    kwargs: passed to RasterWriter, e.g. compress, cog
+    '''
+    minx, miny, maxx, maxy = bounds
+    x_sz = max(1, int(np.ceil((maxx - minx) / resolution)))
+    y_sz = max(1, int(np.ceil((maxy - miny) / resolution)))
+    geotransform = (minx, resolution, 0, maxy, 0, -resolution)
+    windows = grid_windows(x_sz, y_sz, tile_size)
+    logging.info('Interpolating {} x {} grid in {} tiles...'.format(x_sz, y_sz, len(windows)))
+
+    with RasterWriter(out_path, x_sz, y_sz, geotransform, prj_wkt, gdal.GDT_Float32,
+                      nodata_val=nodata, blocksize=tile_size, **kwargs) as writer:
+        writer.write_blocks(interpolate_tiles(interpolator, geotransform, windows,
+                                              nodata=nodata, workers=workers))
+
+
+def points_error_surface(pts_p, out_path, field='abs_diff', method='idw', resolution=2,
+                         k=8, power=2, max_dist=np.inf, **kwargs):
+    '''
+    Interpolates field of all the points in the vector file pts_p to a raster
+    of resolution over their bounds.
+    method: 'idw' or 'linear'
+    '''
+    import geopandas as gpd
+
+    logging.info('Loading points...')
+    pts = gpd.read_file(pts_p)
+    coords = np.column_stack([pts.geometry.x, pts.geometry.y])
+    values = pts[field].values
+    prj_wkt = pts.crs.to_wkt() if pts.crs else ''
+
+    logging.info('Building {} interpolator from {} points...'.format(method, len(pts)))
+    if method == 'idw':
+        interpolator = IDWInterpolator(coords, values, k=k, power=power, max_dist=max_dist)
+    elif method == 'linear':
+        interpolator = LinearInterpolator(coords, values)
+    else:
+        raise ValueError('Unknown interpolation method: {}'.format(method))
+
+    error_surface(interpolator, out_path, pts.total_bounds, resolution, prj_wkt, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('points', type=str,
+                        help='Path to points with error values, e.g. DEM - ICESat differences.')
+    parser.add_argument('out_path', type=str,
+                        help='Path to write error surface GeoTIFF to.')
+    parser.add_argument('-f', '--field', type=str, default='abs_diff',
+                        help='Field of points to interpolate. Default abs_diff')
+    parser.add_argument('-m', '--method', type=str, default='idw', choices=['idw', 'linear'],
+                        help='Inverse distance weighting (k nearest) or linear on a Delaunay triangulation.')
+    parser.add_argument('-r', '--resolution', type=float, default=2,
+                        help='Cell size of the output, in units of the points. Default 2')
+    parser.add_argument('-k', type=int, default=8,
+                        help='Number of nearest points for IDW. Default 8')
+    parser.add_argument('--max_dist', type=float, default=np.inf,
+                        help='Maximum distance to points for IDW, further cells are nodata.')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of threads. Default: number of CPUs')
+    parser.add_argument('--cog', action='store_true',
+                        help='Write a Cloud Optimized GeoTIFF.')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    points_error_surface(args.points, os.path.abspath(args.out_path), field=args.field,
+                         method=args.method, resolution=args.resolution, k=args.k,
+                         max_dist=args.max_dist, workers=args.workers, cog=args.cog)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar container for DEM sample points. Samples are kept as numpy
+columns and geometries are only built when a GeoDataFrame is asked for,
+e.g. to write the samples to GeoPackage or GeoParquet in bulk.
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+
+## Output driver by file extension
+DRIVERS = {'.gpkg': 'GPKG',
+           '.parquet': 'Parquet',
+           '.geoparquet': 'Parquet',
+           '.shp': 'ESRI Shapefile'}
+
+## Column names used in tables of samples
+COLUMNS = {'x': 'x', 'y': 'y', 'z1': 'DEM1_value', 'z2': 'DEM2_value', 'diff': 'Diff'}
+
+
+class PointSamples():
+    '''
+    Sample points of two DEMs as numpy columns: x, y, z1 (DEM1 value),
+    z2 (DEM2 value) and diff (z1 - z2).
+    crs: projection of x and y as WKT (or anything geopandas accepts)
+    '''
+
+    def __init__(self, x, y, z1, z2, crs=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.z1 = np.asarray(z1)
+        self.z2 = np.asarray(z2)
+        self.crs = crs
+        self._diff = None
+
+
+    def __len__(self):
+        return len(self.x)
+
+
+    @property
+    def diff(self):
+        if self._diff is None:
+            self._diff = self.z1 - self.z2
+        return self._diff
+
+
+    @classmethod
+    def concat(cls, samples):
+        '''
+        Combines a list of PointSamples into one, using the crs of the first.
+        '''
+        return cls(np.concatenate([s.x for s in samples]),
+                   np.concatenate([s.y for s in samples]),
+                   np.concatenate([s.z1 for s in samples]),
+                   np.concatenate([s.z2 for s in samples]),
+                   crs=samples[0].crs)
+
+
+    def to_dataframe(self):
+        '''
+        Samples as a pandas DataFrame, without geometries.
+        '''
+        return pd.DataFrame({COLUMNS['x']: self.x, COLUMNS['y']: self.y,
+                             COLUMNS['z1']: self.z1, COLUMNS['z2']: self.z2,
+                             COLUMNS['diff']: self.diff})
+
+
+    def to_geodataframe(self):
+        '''
+        Samples as a GeoDataFrame of points, building the geometries from
+        the x and y columns in one vectorized step.
+        '''
+        import geopandas as gpd
+
+        return gpd.GeoDataFrame(self.to_dataframe(), geometry=gpd.points_from_xy(self.x, self.y),
+                                crs=self.crs)
+
+
+    def write(self, out_path, driver=None, layer=None):
+        '''
+        Writes the samples to out_path in one bulk write. GeoPackage gets an
+        R-tree spatial index, GeoParquet a bounding box column, which readers
+        use to filter by location.
+        driver: 'GPKG', 'Parquet' or an OGR driver name, by default chosen
+                from the extension of out_path. If it is not one of DRIVERS
+                .gpkg is appended and a GeoPackage written.
+        layer: layer name for GeoPackage, defaults to the file name
+        Returns the path written to.
+        '''
+        if driver is None:
+            ext = os.path.splitext(out_path)[1].lower()
+            if ext not in DRIVERS:
+                out_path = out_path + '.gpkg'
+                logging.warning('Unknown extension for samples: {}, writing GeoPackage to {}'.format(
+                                ext, out_path))
+            driver = DRIVERS.get(ext, 'GPKG')
+        if driver == 'ESRI Shapefile' and len(self) > 1000000:
+            logging.warning('Writing {} points to shapefile, GeoPackage or GeoParquet '
+                            'will be much faster.'.format(len(self)))
+
+        logging.info('Writing {} sample points to {}'.format(len(self), out_path))
+        gdf = self.to_geodataframe()
+        if driver == 'Parquet':
+            gdf.to_parquet(out_path, index=False, write_covering_bbox=True)
+        elif driver == 'GPKG':
+            if layer is None:
+                layer = os.path.splitext(os.path.basename(out_path))[0]
+            gdf.to_file(out_path, driver=driver, layer=layer, index=False, SPATIAL_INDEX='YES')
+        else:
+            gdf.to_file(out_path, driver=driver, index=False)
+
+        return out_path
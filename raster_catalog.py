@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite catalog of raster header information (size, geotransform, CRS,
+nodata, data type, block layout, overviews and bounds), so bounds and
+intersection queries over many rasters need no raster opens. Filled by a
+parallel directory scanner and refreshed incrementally by mtime and size.
+Used for header bounds by clip2min_bb. The raster_bounds of RMSE_array and
+RMSE_points are valid data footprints, which need the pixels, so they do not
+use the catalog.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+
+from osgeo import gdal
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rasters (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    x_sz INTEGER,
+    y_sz INTEGER,
+    num_bands INTEGER,
+    geotransform TEXT,
+    crs TEXT,
+    nodata REAL,
+    dtype TEXT,
+    block_x INTEGER,
+    block_y INTEGER,
+    overviews TEXT,
+    minx REAL,
+    miny REAL,
+    maxx REAL,
+    maxy REAL
+);
+CREATE INDEX IF NOT EXISTS rasters_bounds ON rasters (minx, maxx, miny, maxy);
+'''
+
+COLUMNS = ['path', 'mtime', 'size', 'x_sz', 'y_sz', 'num_bands', 'geotransform', 'crs', 'nodata',
+           'dtype', 'block_x', 'block_y', 'overviews', 'minx', 'miny', 'maxx', 'maxy']
+
+
+def scan_directory(directory, suffix):
+    '''
+    Lists one directory with os.scandir, returning ([(path, mtime, size)] of
+    files ending with suffix, [subdirectories]).
+    '''
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(suffix):
+                    st = entry.stat()
+                    files.append((os.path.abspath(entry.path), st.st_mtime, st.st_size))
+    except OSError as e:
+        logging.warning('Could not scan {}: {}'.format(directory, e))
+
+    return files, subdirs
+
+
+def scan_files(directories, suffix='.tif', recursive=True, workers=8):
+    '''
+    Finds files ending with suffix in directories, listing the directories
+    at each level of the tree in parallel (useful on network file systems).
+    Returns a list of (path, mtime, size).
+    '''
+    found = []
+    level = list(directories)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while level:
+            next_level = []
+            for files, subdirs in pool.map(lambda d: scan_directory(d, suffix), level):
+                found.extend(files)
+                next_level.extend(subdirs)
+            level = next_level if recursive else []
+
+    return found
+
+
+def read_header(path):
+    '''
+    Reads the header information of the raster at path into a dict with the
+    catalog COLUMNS (except mtime and size).
+    '''
+    ds = gdal.Open(path)
+    if ds is None:
+        raise IOError('Could not open {}'.format(path))
+    band = ds.GetRasterBand(1)
+    gt = ds.GetGeoTransform()
+    x_sz = ds.RasterXSize
+    y_sz = ds.RasterYSize
+    xs = [gt[0], gt[0] + gt[1] * x_sz + gt[2] * y_sz]
+    ys = [gt[3], gt[3] + gt[4] * x_sz + gt[5] * y_sz]
+    block_x, block_y = band.GetBlockSize()
+    header = {'path': path,
+              'x_sz': x_sz,
+              'y_sz': y_sz,
+              'num_bands': ds.RasterCount,
+              'geotransform': json.dumps(list(gt)),
+              'crs': ds.GetProjectionRef(),
+              'nodata': band.GetNoDataValue(),
+              'dtype': gdal.GetDataTypeName(band.DataType),
+              'block_x': block_x,
+              'block_y': block_y,
+              'overviews': json.dumps([[band.GetOverview(i).XSize, band.GetOverview(i).YSize]
+                                       for i in range(band.GetOverviewCount())]),
+              'minx': min(xs), 'miny': min(ys), 'maxx': max(xs), 'maxy': max(ys)}
+    ds = None
+
+    return header
+
+
+class RasterCatalog():
+    '''
+    Catalog of raster headers in a SQLite database at db_path.
+    Entries are keyed by absolute path and considered up to date while the
+    file's mtime and size are unchanged.
+    '''
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM rasters').fetchone()[0]
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def get(self, path):
+        '''
+        Returns the catalog entry of path as a dict, or None.
+        '''
+        row = self.conn.execute('SELECT * FROM rasters WHERE path = ?',
+                                (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry['geotransform'] = json.loads(entry['geotransform'])
+        entry['overviews'] = json.loads(entry['overviews'])
+
+        return entry
+
+
+    def stale(self, files):
+        '''
+        Returns the (path, mtime, size) of files that are not in the catalog
+        or have changed since they were added.
+        '''
+        known = {row['path']: (row['mtime'], row['size'])
+                 for row in self.conn.execute('SELECT path, mtime, size FROM rasters')}
+
+        return [f for f in files if known.get(f[0]) != (f[1], f[2])]
+
+
+    def add(self, files, workers=8):
+        '''
+        Reads the headers of files [(path, mtime, size)] in a pool of threads
+        and adds or replaces their entries in one transaction.
+        Returns the number of files that could not be read.
+        '''
+        def header(f):
+            path, mtime, size = f
+            try:
+                entry = read_header(path)
+            except Exception as e:
+                logging.warning('Could not read {}: {}'.format(path, e))
+                return None
+            entry.update({'mtime': mtime, 'size': size})
+            return entry
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            entries = [e for e in pool.map(header, files) if e is not None]
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO rasters ({}) VALUES ({})'.format(
+                                  ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                                  [[e[c] for c in COLUMNS] for e in entries])
+
+        return len(files) - len(entries)
+
+
+    def refresh(self, directories, suffix='.tif', recursive=True, prune=True, workers=8):
+        '''
+        Scans directories and (re)reads the headers of new and changed rasters
+        only. prune removes entries under the directories whose files no
+        longer exist.
+        Returns a dict of counts of files found, updated, failed and removed.
+        '''
+        files = scan_files(directories, suffix=suffix, recursive=recursive, workers=workers)
+        stale = self.stale(files)
+        logging.info('Found {} rasters, {} new or changed.'.format(len(files), len(stale)))
+        failed = self.add(stale, workers=workers)
+
+        removed = 0
+        if prune:
+            found = {f[0] for f in files}
+            for directory in directories:
+                prefix = os.path.join(os.path.abspath(directory), '')
+                gone = [(row['path'],) for row in self.conn.execute(
+                        'SELECT path FROM rasters WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+                        if row['path'] not in found]
+                with self.conn:
+                    self.conn.executemany('DELETE FROM rasters WHERE path = ?', gone)
+                removed += len(gone)
+
+        return {'found': len(files), 'updated': len(stale) - failed, 'failed': failed,
+                'removed': removed}
+
+
+    def update_paths(self, paths, workers=8):
+        '''
+        Makes sure the entries of paths are current, stat-ing each file and
+        only reading headers of new or changed files.
+        '''
+        files = []
+        for path in paths:
+            st = os.stat(path)
+            files.append((os.path.abspath(path), st.st_mtime, st.st_size))
+        stale = self.stale(files)
+        if stale:
+            self.add(stale, workers=workers)
+
+
+    def bounds(self, paths):
+        '''
+        Returns {path: (minx, miny, maxx, maxy)} of paths from the catalog.
+        Raises KeyError for paths that are not in the catalog.
+        '''
+        abs_paths = [os.path.abspath(p) for p in paths]
+        rows = {}
+        ## Stay under SQLite's limit on the number of parameters
+        for i in range(0, len(abs_paths), 500):
+            chunk = abs_paths[i:i + 500]
+            rows.update({row['path']: (row['minx'], row['miny'], row['maxx'], row['maxy'])
+                         for row in self.conn.execute(
+                         'SELECT path, minx, miny, maxx, maxy FROM rasters WHERE path IN ({})'.format(
+                         ', '.join('?' * len(chunk))), chunk)})
+        missing = [p for p in abs_paths if p not in rows]
+        if missing:
+            raise KeyError('Not in catalog: {}'.format(', '.join(missing)))
+
+        return {p: rows[a] for p, a in zip(paths, abs_paths)}
+
+
+    def minimum_bounding_box(self, paths, update=True):
+        '''
+        Returns the minimum bounding box of all of paths as a projWin
+        [ulx, uly, lrx, lry], as clip2min_bb.minimum_bounding_box.
+        update: first update entries of paths that are new or changed, which
+                only stats the files unless they changed
+        '''
+        if update:
+            self.update_paths(paths)
+        bounds = list(self.bounds(paths).values())
+        ulx = max(b[0] for b in bounds)
+        uly = min(b[3] for b in bounds)
+        lrx = min(b[2] for b in bounds)
+        lry = max(b[1] for b in bounds)
+
+        return [ulx, uly, lrx, lry]
+
+
+    def intersecting(self, bbox):
+        '''
+        Returns the paths of rasters whose bounds intersect bbox
+        (minx, miny, maxx, maxy).
+        '''
+        minx, miny, maxx, maxy = bbox
+        rows = self.conn.execute('SELECT path FROM rasters WHERE minx < ? AND maxx > ? AND miny < ? AND maxy > ?',
+                                 (maxx, minx, maxy, miny))
+
+        return [row['path'] for row in rows]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_path', type=str,
+                        help='Path to SQLite catalog, created if it does not exist.')
+    parser.add_argument('dirs', nargs='+', type=str,
+                        help='Directories to scan for rasters.')
+    parser.add_argument('-s', '--suffix', type=str, default='.tif',
+                        help='Suffix of rasters. Default .tif')
+    parser.add_argument('--no_recursive', action='store_true',
+                        help='Only scan the given directories, not their subdirectories.')
+    parser.add_argument('--no_prune', action='store_true',
+                        help='Keep entries of files that no longer exist.')
+    parser.add_argument('-j', '--workers', type=int, default=8,
+                        help='Number of threads for scanning and reading headers. Default 8')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    with RasterCatalog(args.db_path) as catalog:
+        counts = catalog.refresh(args.dirs, suffix=args.suffix, recursive=not args.no_recursive,
+                                 prune=not args.no_prune, workers=args.workers)
+        logging.info('Catalog refreshed: {}'.format(counts))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Fast valid data footprints of rasters. The nodata mask is read from an
+overview (or a decimated read when there are none) rather than the full
+resolution raster, polygonized, and simplified.
+"""
+
+import functools
+import logging
+import os
+
+import numpy as np
+from rasterio.features import shapes
+from rasterio.transform import Affine
+from shapely.geometry import shape, MultiPolygon
+from shapely.ops import unary_union
+
+from RasterWrapper import Raster, overview_factors
+
+
+## Largest number of pixels to polygonize when computing a footprint
+MAX_PIXELS = 4 * 1024**2
+
+
+def footprint_mask(path, max_pixels=MAX_PIXELS, nodata=None):
+    '''
+    Reads a reduced resolution valid data mask of the raster at path.
+    Uses the finest overview that gets close to max_pixels, falling back to
+    a decimated (nearest neighbour) read if there are no overviews.
+    nodata: nodata value to use instead of the raster's
+    Returns (valid, geotransform), where geotransform is that of the mask.
+    '''
+    raster = Raster(path, lazy=True)
+    factor = np.sqrt(raster.x_sz * raster.y_sz / max_pixels)
+    if factor > 1 and overview_factors(raster.data_src):
+        raster = Raster(path, lazy=True, resolution=abs(raster.pixel_width) * factor)
+
+    if nodata is None:
+        nodata = raster.nodata_val
+
+    gt = list(raster.geotransform)
+    if raster.x_sz * raster.y_sz > 4 * max_pixels:
+        ## No suitable overview, let GDAL decimate while reading
+        step = int(np.ceil(np.sqrt(raster.x_sz * raster.y_sz / max_pixels)))
+        buf_x = -(-raster.x_sz // step)
+        buf_y = -(-raster.y_sz // step)
+        logging.debug('Decimating {} by {} to get footprint.'.format(path, step))
+        arr = raster.GetBand(1).ReadAsArray(0, 0, raster.x_sz, raster.y_sz, buf_x, buf_y)
+        gt[1] = gt[1] * raster.x_sz / buf_x
+        gt[5] = gt[5] * raster.y_sz / buf_y
+    else:
+        arr = raster.ReadWindow(0, 0, raster.x_sz, raster.y_sz, cache=False)
+
+    valid = np.ones(arr.shape, dtype=bool)
+    if nodata is not None:
+        valid &= arr != nodata
+    if np.issubdtype(arr.dtype, np.floating):
+        valid &= ~np.isnan(arr)
+
+    return valid, tuple(gt)
+
+
+@functools.lru_cache(maxsize=256)
+def cached_footprint(path, mtime, nodata, max_pixels, tolerance):
+    '''
+    Computes the footprint, cached by path, modification time, nodata value
+    and parameters so repeated calls on an unchanged file are free.
+    '''
+    valid, gt = footprint_mask(path, max_pixels=max_pixels, nodata=nodata)
+    if tolerance is None:
+        ## Simplify to the resolution of the mask
+        tolerance = abs(gt[1])
+
+    polygons = [shape(geom) for geom, value in shapes(valid.view(np.uint8), mask=valid,
+                                                      transform=Affine.from_gdal(*gt))
+                if value == 1]
+    footprint = unary_union(polygons)
+    if tolerance:
+        footprint = footprint.simplify(tolerance, preserve_topology=True)
+    if footprint.geom_type == 'Polygon':
+        footprint = MultiPolygon([footprint])
+
+    return footprint
+
+
+def valid_footprint(path, nodata=None, max_pixels=MAX_PIXELS, tolerance=None):
+    '''
+    Returns the footprint of the valid (not nodata) pixels of the raster at
+    path as a shapely MultiPolygon, including all parts of multipart coverage.
+    nodata: nodata value to use instead of the raster's
+    max_pixels: approximate size of the mask that is polygonized, an overview
+                or decimated read of about this size is used
+    tolerance: simplification tolerance in the units of the raster, defaults
+               to the pixel size of the mask, 0 to not simplify. Simplified
+               footprints can extend over nodata, use 0 when sampling within
+               the footprint
+    '''
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+
+    return cached_footprint(path, mtime, nodata, max_pixels, tolerance)
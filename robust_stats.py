@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Robust statistics of DEM differences (median, NMAD, percentiles,
+histogram) computed block by block with a mergeable fixed bin histogram,
+so they can be combined across blocks and workers in bounded memory.
+"""
+
+import logging
+
+import numpy as np
+
+from RasterWrapper import Raster
+from RMSE_array_2 import DiffStats, iter_diff_blocks
+
+
+## Scale factor making the median absolute deviation a consistent
+## estimator of standard deviation for normal errors
+NMAD_SCALE = 1.4826
+
+
+class DiffHistogram():
+    '''
+    Fixed bin histogram of differences. Histograms with the same bins can be
+    merged, so per-block and per-worker results can be combined. Quantiles are
+    interpolated within bins, so are accurate to about bin_width.
+    Values outside [-limit, limit] are counted in underflow / overflow.
+    '''
+
+    def __init__(self, bin_width=0.01, limit=100.0):
+        '''
+        bin_width: width of bins in the units of the differences (e.g. 1 cm)
+        limit: bins cover -limit to limit
+        '''
+        self.bin_width = bin_width
+        self.limit = limit
+        self.num_bins = int(round(2 * limit / bin_width))
+        self.counts = np.zeros(self.num_bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+
+    @property
+    def edges(self):
+        return -self.limit + self.bin_width * np.arange(self.num_bins + 1)
+
+
+    def update(self, diffs):
+        '''
+        Adds an array of differences.
+        '''
+        diffs = np.asarray(diffs, dtype=np.float64).ravel()
+        if diffs.size == 0:
+            return
+        idx = np.floor((diffs + self.limit) / self.bin_width).astype(np.int64)
+        in_range = (idx >= 0) & (idx < self.num_bins)
+        self.counts += np.bincount(idx[in_range], minlength=self.num_bins)
+        self.underflow += int((idx < 0).sum())
+        self.overflow += int((idx >= self.num_bins).sum())
+        self.count += diffs.size
+        self.min = min(self.min, diffs.min())
+        self.max = max(self.max, diffs.max())
+
+
+    def merge(self, other):
+        '''
+        Adds the counts of other, which must have the same bins.
+        '''
+        if other.bin_width != self.bin_width or other.limit != self.limit:
+            raise ValueError('Cannot merge histograms with different bins.')
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+
+    def __add__(self, other):
+        merged = DiffHistogram(bin_width=self.bin_width, limit=self.limit)
+        merged.merge(self)
+        merged.merge(other)
+
+        return merged
+
+
+    def quantile(self, q):
+        '''
+        Approximate quantile(s) q (0 to 1) of the differences. Quantiles that
+        fall outside the bins are returned as the min or max.
+        '''
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        ## Cumulative counts at each bin edge, including underflow
+        cum = self.underflow + np.concatenate([[0], np.cumsum(self.counts)])
+        target = q * self.count
+        values = np.interp(target, cum, self.edges)
+        ## interp clamps to the range of the bins, use min / max outside it
+        values = np.where(target < self.underflow, self.min, values)
+        values = np.where(target > cum[-1], self.max, values)
+        if ((target < self.underflow) | (target > cum[-1])).any():
+            logging.warning('Quantile outside histogram limit of +/-{}.'.format(self.limit))
+
+        return values
+
+
+    def percentile(self, p):
+        return self.quantile(np.asarray(p, dtype=np.float64) / 100)
+
+
+    @property
+    def median(self):
+        return float(self.quantile(0.5))
+
+
+    @property
+    def nmad(self):
+        '''
+        Normalized median absolute deviation from the median.
+        '''
+        if self.count == 0:
+            return np.nan
+        median = self.median
+        ## Distribution of absolute deviations of the bin centers, values outside
+        ## the bins are further from the median than any bin
+        centers = self.edges[:-1] + self.bin_width / 2
+        deviations = np.abs(centers - median)
+        order = np.argsort(deviations)
+        cum = np.cumsum(self.counts[order])
+        i = np.searchsorted(cum, 0.5 * self.count)
+        if i >= len(cum):
+            logging.warning('NMAD outside histogram limit of +/-{}.'.format(self.limit))
+            return np.nan
+
+        return NMAD_SCALE * float(deviations[order][i])
+
+
+    def summary(self, percentiles=(1, 5, 25, 75, 95, 99)):
+        summary = {'count': int(self.count), 'median': self.median, 'nmad': self.nmad,
+                   'min': float(self.min), 'max': float(self.max)}
+        for p, value in zip(percentiles, self.percentile(percentiles)):
+            summary['p{}'.format(p)] = float(value)
+
+        return summary
+
+
+def robust_summary(diffs, percentiles=(1, 5, 25, 75, 95, 99)):
+    '''
+    Exact median, NMAD and percentiles of an in memory array of differences,
+    e.g. from sample points.
+    '''
+    diffs = np.asarray(diffs, dtype=np.float64)
+    median = np.median(diffs)
+    summary = {'count': int(diffs.size), 'median': float(median),
+               'nmad': float(NMAD_SCALE * np.median(np.abs(diffs - median))),
+               'min': float(diffs.min()), 'max': float(diffs.max())}
+    for p, value in zip(percentiles, np.percentile(diffs, percentiles)):
+        summary['p{}'.format(p)] = float(value)
+
+    return summary
+
+
+def dem_diff_robust_stats(dem1_p, dem2_p, bin_width=0.01, limit=100.0):
+    '''
+    Streams the differences dem1 - dem2 over the full overlap block by block
+    in a single pass, accumulating both the moments (DiffStats: RMSE, mean,
+    std) and a DiffHistogram (median, NMAD, percentiles).
+    Returns (DiffStats, DiffHistogram).
+    '''
+    dem1 = Raster(dem1_p, lazy=True)
+    dem2 = Raster(dem2_p, lazy=True)
+    stats = DiffStats()
+    hist = DiffHistogram(bin_width=bin_width, limit=limit)
+    for diffs in iter_diff_blocks(dem1, dem2):
+        stats.update(diffs)
+        hist.update(diffs)
+
+    return stats, hist
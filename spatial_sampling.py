@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Seeded, vectorized generation of sample points within a region, e.g. the
+valid overlap of two DEMs. Points can be uniform random, stratified on a
+grid (one jittered point per cell) or Poisson-disk (no two points closer
+than a radius), the latter two giving even coverage with fewer points.
+"""
+
+import logging
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+MODES = ('uniform', 'stratified', 'poisson')
+
+
+def get_rng(seed=None):
+    '''
+    Returns a numpy Generator from a seed, or seed itself if it is already
+    a Generator so one can be shared between calls.
+    '''
+    return np.random.default_rng(seed)
+
+
+def _uniform_candidates(size, bounds, rng):
+    min_x, min_y, max_x, max_y = bounds
+    return rng.uniform(min_x, max_x, size), rng.uniform(min_y, max_y, size)
+
+
+def _stratified_candidates(cell_size, bounds, rng):
+    '''
+    One point at a random location in each cell of a grid of cell_size
+    covering bounds.
+    '''
+    min_x, min_y, max_x, max_y = bounds
+    nx = max(1, int(np.ceil((max_x - min_x) / cell_size)))
+    ny = max(1, int(np.ceil((max_y - min_y) / cell_size)))
+    cols, rows = np.meshgrid(np.arange(nx), np.arange(ny))
+    xs = min_x + (cols.ravel() + rng.random(nx * ny)) * cell_size
+    ys = min_y + (rows.ravel() + rng.random(nx * ny)) * cell_size
+    keep = (xs <= max_x) & (ys <= max_y)
+
+    return xs[keep], ys[keep]
+
+
+def _filter(xs, ys, within):
+    if within is None:
+        return xs, ys
+    inside = within(xs, ys)
+    return xs[inside], ys[inside]
+
+
+def estimate_area(bounds, within=None, rng=None, size=10000):
+    '''
+    Estimates the area of the region from the fraction of uniform points
+    over bounds that fall within it.
+    '''
+    min_x, min_y, max_x, max_y = bounds
+    area = (max_x - min_x) * (max_y - min_y)
+    if within is None:
+        return area
+    xs, ys = _uniform_candidates(size, bounds, get_rng(rng))
+    hit_rate = within(xs, ys).mean()
+
+    return area * hit_rate
+
+
+def uniform_points(n, bounds, within=None, rng=None, batch_size=10000, max_batch_size=1000000,
+                   max_candidates=100000000, area=None):
+    '''
+    n uniform random points within bounds and the region, drawn in batches
+    and tested against the region all at once. Batches are sized from the
+    fraction of bounds covered by the region, but never over max_batch_size
+    candidates.
+    max_candidates: raise a ValueError if no point is found in this many
+    area: area of the region if known (e.g. of a polygon), otherwise estimated
+    '''
+    rng = get_rng(rng)
+    if area is None:
+        area = estimate_area(bounds, within, rng)
+    hit_rate = area / ((bounds[2] - bounds[0]) * (bounds[3] - bounds[1]))
+    xs, ys = [], []
+    num_found = 0
+    num_drawn = 0
+    while num_found < n:
+        size = int(1.2 * (n - num_found) / hit_rate) if hit_rate > 0 else max_batch_size
+        size = min(max(batch_size, size), max_batch_size)
+        x, y = _filter(*_uniform_candidates(size, bounds, rng), within)
+        xs.append(x)
+        ys.append(y)
+        num_found += len(x)
+        num_drawn += size
+        if num_found == 0 and num_drawn >= max_candidates:
+            raise ValueError('No points found within region in {} candidates.'.format(num_drawn))
+        if hit_rate <= 0 and num_found:
+            ## Region was missed by the area estimate, use the hits so far
+            hit_rate = num_found / num_drawn
+
+    return np.concatenate(xs)[:n], np.concatenate(ys)[:n]
+
+
+def stratified_points(n, bounds, within=None, rng=None, max_tries=10, area=None):
+    '''
+    n points, at most one in each cell of a square grid sized so that about
+    n cells fall within the region, returned in random order.
+    area: area of the region if known, otherwise estimated
+    '''
+    rng = get_rng(rng)
+    if area is None:
+        area = estimate_area(bounds, within, rng)
+    if area <= 0:
+        raise ValueError('Region to sample is empty.')
+    cell_size = np.sqrt(area / n)
+    for _i in range(max_tries):
+        xs, ys = _filter(*_stratified_candidates(cell_size, bounds, rng), within)
+        if len(xs) >= n:
+            break
+        ## Lost cells on the edges of the region, use smaller cells
+        cell_size *= np.sqrt(max(len(xs), 1) / n) * 0.95
+    else:
+        logging.warning('Only found {} of {} stratified points.'.format(len(xs), n))
+    picked = rng.choice(len(xs), size=min(n, len(xs)), replace=False)
+
+    return xs[picked], ys[picked]
+
+
+def poisson_points(n, bounds, within=None, rng=None, radius=None, max_rounds=50, area=None):
+    '''
+    n points with no two closer than radius (Poisson-disk), by dart throwing
+    in vectorized rounds: candidates too close to accepted points are rejected
+    with a KD-tree, and of candidates too close to each other only the first
+    is kept.
+    radius: minimum distance between points, by default about 3/5 of the
+            spacing of n evenly spread points, well below the packing limit
+    area: area of the region if known, otherwise estimated once for all rounds
+    '''
+    rng = get_rng(rng)
+    if area is None:
+        area = estimate_area(bounds, within, rng)
+    if area <= 0:
+        raise ValueError('Region to sample is empty.')
+    if radius is None:
+        radius = np.sqrt(0.35 * area / n)
+    xs = np.empty(0)
+    ys = np.empty(0)
+    for _i in range(max_rounds):
+        cand_x, cand_y = stratified_points(2 * (n - len(xs)), bounds, within, rng, area=area)
+        cand = np.column_stack([cand_x, cand_y])
+        if len(xs):
+            dist, _idx = cKDTree(np.column_stack([xs, ys])).query(cand, distance_upper_bound=radius)
+            cand = cand[np.isinf(dist)]
+        ## Drop the later point of each pair of candidates that are too close
+        pairs = cKDTree(cand).query_pairs(radius, output_type='ndarray')
+        keep = np.ones(len(cand), dtype=bool)
+        keep[pairs.max(axis=1)] = False
+        cand = cand[keep][:n - len(xs)]
+        xs = np.concatenate([xs, cand[:, 0]])
+        ys = np.concatenate([ys, cand[:, 1]])
+        if len(xs) >= n:
+            break
+    else:
+        logging.warning('Only found {} of {} Poisson-disk points with radius {}.'.format(
+                        len(xs), n, radius))
+    order = rng.permutation(len(xs))
+
+    return xs[order], ys[order]
+
+
+def sample_region(n, bounds, within=None, mode='uniform', seed=None, **kwargs):
+    '''
+    Generates n sample points within bounds and, optionally, a region.
+    bounds: (min_x, min_y, max_x, max_y)
+    within: function taking arrays of x and y and returning a boolean array of
+            whether each point is in the region, e.g. in the valid overlap
+    mode: 'uniform', 'stratified' or 'poisson'
+    seed: seed or numpy Generator, the same seed gives the same points
+    Returns arrays of x and y.
+    '''
+    rng = get_rng(seed)
+    if mode == 'uniform':
+        return uniform_points(n, bounds, within, rng, **kwargs)
+    elif mode == 'stratified':
+        return stratified_points(n, bounds, within, rng, **kwargs)
+    elif mode == 'poisson':
+        return poisson_points(n, bounds, within, rng, **kwargs)
+    else:
+        raise ValueError('Unknown sampling mode: {}. Must be one of {}'.format(mode, MODES))
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Process wide LRU cache of raster blocks, shared by all Raster objects so
+that the same native block is only read and decoded once.
+"""
+
+import collections
+import logging
+import os
+import threading
+
+
+## Default byte budget of the shared cache (256 MB)
+DEFAULT_MAX_BYTES = 256 * 1024**2
+
+
+class TileCache():
+    '''
+    LRU cache of raster blocks (numpy arrays) keyed by
+    (path, file_id, band, overview, block_x, block_y), where file_id is
+    file_identity(path) so blocks of a rewritten file are not reused, and
+    overview is the overview index or None for full resolution, with a byte
+    budget. When the budget is exceeded the least recently used blocks are
+    evicted.
+    Keeps hit, miss and eviction counters to help with sizing the cache.
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            ## The lock may be held by another thread of the parent when forking
+            os.register_at_fork(after_in_child=self._after_fork)
+
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._tiles = collections.OrderedDict()
+        self.nbytes = 0
+
+
+    def __len__(self):
+        return len(self._tiles)
+
+
+    def __contains__(self, key):
+        return key in self._tiles
+
+
+    def get(self, key, read_block):
+        '''
+        Returns the block stored under key, calling read_block() to read it
+        on a miss. Blocks are returned read-only as they are shared.
+        key: (path, file_id, band, overview, block_x, block_y)
+        read_block: function with no arguments returning the block as an array
+        '''
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+
+        ## Read outside of the lock so other threads are not blocked on IO
+        tile = read_block()
+        tile.setflags(write=False)
+
+        with self._lock:
+            if key not in self._tiles and tile.nbytes <= self.max_bytes:
+                self._tiles[key] = tile
+                self.nbytes += tile.nbytes
+                self._evict()
+
+        return tile
+
+
+    def _evict(self):
+        '''
+        Drops least recently used blocks until within the byte budget.
+        '''
+        while self.nbytes > self.max_bytes and self._tiles:
+            _key, tile = self._tiles.popitem(last=False)
+            self.nbytes -= tile.nbytes
+            self.evictions += 1
+
+
+    def resize(self, max_bytes):
+        '''
+        Changes the byte budget, evicting blocks if needed.
+        '''
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+
+    def clear(self):
+        '''
+        Removes all blocks from the cache. Counters are kept.
+        '''
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+
+
+    def invalidate(self, path):
+        '''
+        Removes all blocks of path, e.g. once it has been rewritten.
+        '''
+        with self._lock:
+            for key in [k for k in self._tiles if k[0] == path]:
+                self.nbytes -= self._tiles.pop(key).nbytes
+
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+    def stats(self):
+        '''
+        Returns a dict of cache counters and current size.
+        '''
+        with self._lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / requests if requests else 0.0,
+                    'tiles': len(self._tiles),
+                    'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes}
+
+
+    def log_stats(self, level=logging.INFO):
+        s = self.stats()
+        logging.log(level, 'Tile cache: {} hits, {} misses ({:.1%} hit rate), {} evictions, '
+                    '{} tiles using {:.1f} of {:.1f} MB'.format(
+                    s['hits'], s['misses'], s['hit_rate'], s['evictions'], s['tiles'],
+                    s['nbytes'] / 1024**2, s['max_bytes'] / 1024**2))
+
+
+## Cache shared by all Raster objects in the process
+tile_cache = TileCache()
+
+
+def file_identity(path):
+    '''
+    Returns (modification time in ns, size) of the file at path, or None for
+    paths that are not files (e.g. /vsimem/ or URLs).
+    '''
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def get_tile_cache():
+    return tile_cache
+
+
+def set_tile_cache_size(max_bytes):
+    '''
+    Sets the byte budget of the shared tile cache.
+    '''
+    tile_cache.resize(max_bytes)